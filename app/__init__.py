@@ -1,8 +1,10 @@
+import atexit
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_socketio import SocketIO
 from flask_migrate import Migrate
+from sqlalchemy import event
 from config import Config
 
 db = SQLAlchemy()
@@ -10,12 +12,31 @@ migrate = Migrate()
 login_manager = LoginManager()
 socketio = SocketIO()
 
+def configure_sqlite(app):
+    """Apply the configured SQLITE_PRAGMAS to every new SQLite connection"""
+    pragmas = app.config['SQLITE_PRAGMAS']
+    if not pragmas:
+        return
+
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
 
     # Initialize extensions
     db.init_app(app)
+    configure_sqlite(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
     socketio.init_app(app)
@@ -30,10 +51,24 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.cli import bp as cli_bp
+    app.register_blueprint(cli_bp)
+
     # Create database tables
     with app.app_context():
         db.create_all()
 
+    # Optional group-commit pipeline for incoming chat messages
+    from app.pipeline import message_writer
+    message_writer.init_app(app)
+    if app.config['MESSAGE_GROUP_COMMIT'] and not message_writer.running:
+        message_writer.start()
+        atexit.register(message_writer.stop)
+
+    # LAN outbox; started by init_network once a network manager exists
+    from app.outbox import outbox
+    outbox.init_app(app)
+
     return app
 
 from app import models 
\ No newline at end of file
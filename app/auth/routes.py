@@ -1,4 +1,4 @@
-from flask import render_template, redirect, url_for, flash, request
+from flask import render_template, redirect, url_for, flash, request, current_app
 from flask_login import login_user, logout_user, current_user, login_required
 from urllib.parse import urlparse
 from app import db
@@ -6,6 +6,7 @@ from app.auth import bp
 from app.models import User
 from app.auth.forms import LoginForm, RegistrationForm
 from app.network import init_network, get_network_manager
+from app.encryption import init_encryption
 
 @bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -22,7 +23,8 @@ def login():
         login_user(user, remember=form.remember_me.data)
         
         # Initialize network manager for the user
-        init_network(user.phone_number)
+        init_network(user.phone_number, current_app._get_current_object())
+        init_encryption(user.id, current_app._get_current_object())
         
         next_page = request.args.get('next')
         if not next_page or urlparse(next_page).netloc != '':
@@ -0,0 +1,128 @@
+import glob
+import hashlib
+import mimetypes
+import os
+import re
+import tempfile
+from flask import current_app, request, send_file
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Blob, conflict_insert
+
+# Bytes read per step when spooling a stream into the store
+BLOCK_SIZE = 64 * 1024
+
+_BLOB_NAME = re.compile(r'^([0-9a-f]{64})(\.[A-Za-z0-9]+)?$')
+
+def blob_path(sha256):
+    """Location of a blob, sharded two levels deep by its leading hex digits"""
+    return os.path.join(current_app.config['BLOB_FOLDER'], sha256[:2], sha256[2:4], sha256)
+
+def staging_dir():
+    """Directory for files still being written; on the same filesystem as the store"""
+    path = os.path.join(current_app.config['BLOB_FOLDER'], '.partial')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def blob_name(sha256, filename):
+    """Public name of a blob: its digest plus the original extension, for MIME typing"""
+    ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    return f'{sha256}.{ext}' if ext else sha256
+
+def parse_blob_name(name):
+    """Digest encoded in a blob name, or None for legacy flat upload names"""
+    match = _BLOB_NAME.match(name)
+    return match.group(1) if match else None
+
+def exists(sha256):
+    return db.session.get(Blob, sha256) is not None and os.path.exists(blob_path(sha256))
+
+def put_file(path, sha256, size):
+    """Move a completely written file into the store, dropping it if the content is known.
+
+    The Blob row is created with no references; add_message takes one per
+    message that carries the blob. Calling it again for the same file is
+    harmless.
+    """
+    dest = blob_path(sha256)
+    if os.path.exists(dest):
+        # The file is already gone if a rolled-back attempt moved it in
+        if os.path.exists(path):
+            os.remove(path)
+    else:
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        os.replace(path, dest)
+
+    stmt = conflict_insert(Blob)
+    if stmt is not None:
+        db.session.execute(
+            stmt.values(sha256=sha256, size=size, ref_count=0)
+            .on_conflict_do_nothing(index_elements=['sha256'])
+        )
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(db.insert(Blob).values(sha256=sha256, size=size, ref_count=0))
+    except IntegrityError:
+        pass  # Already stored
+
+def put_stream(stream):
+    """Spool a stream into the store, hashing it on the way; returns (sha256, size)"""
+    sha256 = hashlib.sha256()
+    size = 0
+    with tempfile.NamedTemporaryFile(dir=staging_dir(), delete=False) as f:
+        for block in iter(lambda: stream.read(BLOCK_SIZE), b''):
+            sha256.update(block)
+            f.write(block)
+            size += len(block)
+
+    digest = sha256.hexdigest()
+    put_file(f.name, digest, size)
+    return digest, size
+
+def send_blob(sha256, download_name):
+    """Response serving a blob with byte ranges, a content-hash ETag and immutable caching.
+
+    With X_ACCEL_REDIRECT_PREFIX set, the bytes are left to the front proxy
+    and Flask only answers conditional requests. Flask's own USE_X_SENDFILE
+    setting is honoured by ``send_file`` as usual.
+    """
+    prefix = current_app.config['X_ACCEL_REDIRECT_PREFIX']
+    max_age = current_app.config['BLOB_MAX_AGE']
+    path = blob_path(sha256)
+
+    if prefix:
+        internal_path = os.path.relpath(path, current_app.config['BLOB_FOLDER']).replace(os.sep, '/')
+        response = current_app.response_class(
+            mimetype=mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+        )
+        response.headers['X-Accel-Redirect'] = f"{prefix.rstrip('/')}/{internal_path}"
+        response.headers.set('Content-Disposition', 'inline', filename=download_name)
+        response.set_etag(sha256)
+    else:
+        # send_file handles Range, If-Range and If-None-Match against the ETag
+        response = send_file(path, download_name=download_name, etag=sha256, max_age=max_age)
+        response.accept_ranges = 'bytes'
+
+    # Content at a digest never changes, but it is only for logged-in parties
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = True
+    return response.make_conditional(request) if prefix else response
+
+def collect_garbage():
+    """Delete blobs no message refers to; returns the number removed"""
+    removed = 0
+    for blob in Blob.query.filter(Blob.ref_count <= 0).all():
+        path = blob_path(blob.sha256)
+        # The blob itself plus any derived files stored next to it, e.g. thumbnails
+        for derived in [path] + glob.glob(f'{glob.escape(path)}.*'):
+            try:
+                os.remove(derived)
+            except FileNotFoundError:
+                pass
+        db.session.delete(blob)
+        removed += 1
+    db.session.commit()
+    return removed
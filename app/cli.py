@@ -0,0 +1,19 @@
+import click
+from flask import Blueprint
+from app import db, blobstore
+from app.models import MessageDailyStats
+
+bp = Blueprint('cli', __name__, cli_group=None)
+
+@bp.cli.command('rebuild-stats')
+def rebuild_stats():
+    """Rebuild the daily message rollup from existing messages."""
+    MessageDailyStats.rebuild()
+    db.session.commit()
+    click.echo(f'Rebuilt {MessageDailyStats.query.count()} daily stats rows.')
+
+@bp.cli.command('gc-blobs')
+def gc_blobs():
+    """Delete stored attachments that no message refers to any more."""
+    removed = blobstore.collect_garbage()
+    click.echo(f'Removed {removed} unreferenced blobs.')
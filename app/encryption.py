@@ -1,54 +1,366 @@
 import os
+import threading
 import time
 from cryptography.hazmat.primitives.asymmetric import x25519, ed25519
-from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives import hashes, hmac, serialization
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from base64 import b64encode, b64decode
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
+import struct
+from app.keystore import Keystore
+
+# Message keys kept per chain, so skipped and re-read messages decrypt without walking the chain
+MAX_CACHED_MESSAGE_KEYS = 1000
+# Chain keys kept every this many steps, bounding the walk to re-derive an evicted key.
+# Only checkpoints for the last MAX_CACHED_MESSAGE_KEYS messages are kept: an older
+# chain key would let anyone holding it re-derive every later message key.
+CHAIN_CHECKPOINT_INTERVAL = 64
+# Most keys a chain derives ahead to reach one message number; the number comes from the peer
+MAX_SKIP = 1000
+# One-time pre-keys kept available; the pool is topped up in the background
+PRE_KEY_POOL_SIZE = 20
+# AES-GCM releases the GIL, so history pages are decrypted across this many threads
+DECRYPT_WORKERS = min(8, os.cpu_count() or 1)
+# Smaller batches are decrypted inline; handing them to the pool costs more than it saves
+PARALLEL_DECRYPT_MIN = 64
+
+# Binary envelope: version, message number and nonce, then the AES-GCM ciphertext.
+# Envelopes written before it are JSON text and still decrypt.
+ENVELOPE_VERSION = 2
+ENVELOPE_HEADER = struct.Struct('!BI12s')
+
+def pack_envelope(message_number, nonce, ciphertext):
+    return ENVELOPE_HEADER.pack(ENVELOPE_VERSION, message_number, nonce) + ciphertext
+
+def unpack_envelope(envelope):
+    """Split an envelope, binary or legacy JSON, into (message_number, nonce, ciphertext)"""
+    if isinstance(envelope, str) or envelope[:1] == b'{':
+        message_data = json.loads(envelope)
+        return (message_data['message_number'], b64decode(message_data['nonce']),
+                b64decode(message_data['ciphertext']))
+    if len(envelope) < ENVELOPE_HEADER.size:
+        raise ValueError('Truncated message envelope')
+    version, message_number, nonce = ENVELOPE_HEADER.unpack_from(envelope)
+    if version != ENVELOPE_VERSION:
+        raise ValueError(f'Unsupported envelope version {version}')
+    return message_number, nonce, memoryview(envelope)[ENVELOPE_HEADER.size:]
+
+# Attachments are sealed in chunks of this many bytes (STREAM construction): each chunk's
+# nonce is a random per-file prefix, the chunk counter and a last-chunk flag
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_TAG_SIZE = 16
+STREAM_VERSION = 1
+STREAM_HEADER = struct.Struct('!BI7s')  # version, message number, nonce prefix
+STREAM_NONCE = struct.Struct('!7sIB')
+
+def stream_ciphertext_size(size):
+    """Bytes an encrypted stream of ``size`` plaintext bytes takes, header included"""
+    chunks = max(1, -(-size // STREAM_CHUNK_SIZE))
+    return STREAM_HEADER.size + size + chunks * STREAM_TAG_SIZE
+
+class StreamEncryptor:
+    """Seals a file chunk by chunk, so memory use does not grow with its size"""
+    def __init__(self, key, message_number):
+        self.aesgcm = AESGCM(key)
+        self.message_number = message_number
+        self.prefix = os.urandom(7)
+
+    def chunks(self, f):
+        """Yield the header, then every sealed chunk of file object ``f``"""
+        yield STREAM_HEADER.pack(STREAM_VERSION, self.message_number, self.prefix)
+        counter = 0
+        chunk = f.read(STREAM_CHUNK_SIZE)
+        while True:
+            # Read one chunk ahead: the last chunk is sealed with its flag set
+            following = f.read(STREAM_CHUNK_SIZE) if len(chunk) == STREAM_CHUNK_SIZE else b''
+            nonce = STREAM_NONCE.pack(self.prefix, counter, 0 if following else 1)
+            yield self.aesgcm.encrypt(nonce, chunk, None)
+            if not following:
+                return
+            chunk = following
+            counter += 1
+
+class StreamDecryptor:
+    """Opens a sealed stream fed in pieces of any size, one chunk at a time.
+
+    ``key_for`` maps the message number in the stream header to its key.
+    A truncated or reordered stream fails authentication in finalize().
+    """
+    def __init__(self, key_for):
+        self.key_for = key_for
+        self.aesgcm = None
+        self.prefix = None
+        self.counter = 0
+        self.buffer = bytearray()
+
+    def _open(self, sealed, last):
+        nonce = STREAM_NONCE.pack(self.prefix, self.counter, 1 if last else 0)
+        self.counter += 1
+        return self.aesgcm.decrypt(nonce, sealed, None)
+
+    def update(self, data):
+        """Feed ciphertext; returns the plaintext of every chunk it completed"""
+        self.buffer += data
+        if self.aesgcm is None:
+            if len(self.buffer) < STREAM_HEADER.size:
+                return b''
+            version, message_number, self.prefix = STREAM_HEADER.unpack_from(self.buffer)
+            if version != STREAM_VERSION:
+                raise ValueError(f'Unsupported stream version {version}')
+            self.aesgcm = AESGCM(self.key_for(message_number))
+            del self.buffer[:STREAM_HEADER.size]
+
+        # A full chunk is only opened once more data follows it; the final one waits for finalize()
+        sealed_size = STREAM_CHUNK_SIZE + STREAM_TAG_SIZE
+        plaintext = []
+        while len(self.buffer) > sealed_size:
+            plaintext.append(self._open(bytes(self.buffer[:sealed_size]), last=False))
+            del self.buffer[:sealed_size]
+        return b''.join(plaintext)
+
+    def finalize(self):
+        """Open the last chunk; raises if the stream was cut short"""
+        if self.aesgcm is None or len(self.buffer) < STREAM_TAG_SIZE:
+            raise ValueError('Truncated encrypted stream')
+        plaintext = self._open(bytes(self.buffer), last=True)
+        self.buffer.clear()
+        return plaintext
+
+_decrypt_pool = ThreadPoolExecutor(max_workers=DECRYPT_WORKERS, thread_name_prefix='decrypt')
+
+def _open_sealed(jobs):
+    """Decrypt (key, nonce, ciphertext) triples; None for any that fail authentication"""
+    plaintexts = []
+    for message_key, nonce, ciphertext in jobs:
+        try:
+            plaintexts.append(AESGCM(message_key).decrypt(nonce, ciphertext, None).decode())
+        except Exception as e:
+            print(f"Error decrypting message: {e}")
+            plaintexts.append(None)
+    return plaintexts
+
+def _raw_private(key):
+    return key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw,
+                             serialization.NoEncryption())
+
+def _raw_public(key):
+    return key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+
+def kdf_chain_step(chain_key):
+    """Advance a symmetric chain with one HMAC-SHA512: returns (next_chain_key, message_key)"""
+    h = hmac.HMAC(chain_key, hashes.SHA512())
+    h.update(b'\x01')
+    output = h.finalize()
+    return output[:32], output[32:]
+
+class KDFChain:
+    """One direction of a session: a chain key stepped once per message.
+
+    Keys for messages that arrive out of order, or are decrypted again when
+    history is reloaded, come from an LRU cache. Keys evicted from the cache
+    are re-derived from the nearest earlier checkpoint of the chain key, as
+    long as the message is among the last MAX_CACHED_MESSAGE_KEYS.
+    """
+    def __init__(self, chain_key):
+        self.chain_key = chain_key
+        self.index = 0
+        self.message_keys = OrderedDict()
+        self.checkpoints = {0: chain_key}  # position -> chain key at index position * interval
+
+    @classmethod
+    def restore(cls, index, chain_key, checkpoints):
+        """A chain as state() left it; skipped keys are re-derived from the checkpoints"""
+        chain = cls(chain_key)
+        chain.index = index
+        chain.checkpoints = dict(checkpoints)
+        chain._prune_checkpoints()
+        return chain
+
+    @property
+    def oldest_recoverable(self):
+        """Lowest message number whose key can still be re-derived"""
+        return max(0, self.index - MAX_CACHED_MESSAGE_KEYS)
+
+    def state(self):
+        return self.index, self.chain_key, self.checkpoints
+
+    def _remember(self, n, message_key):
+        self.message_keys[n] = message_key
+        if len(self.message_keys) > MAX_CACHED_MESSAGE_KEYS:
+            self.message_keys.popitem(last=False)
+
+    def _advance(self):
+        n = self.index
+        self.chain_key, message_key = kdf_chain_step(self.chain_key)
+        self.index += 1
+        if self.index % CHAIN_CHECKPOINT_INTERVAL == 0:
+            self.checkpoints[self.index // CHAIN_CHECKPOINT_INTERVAL] = self.chain_key
+            self._prune_checkpoints()
+        self._remember(n, message_key)
+        return n, message_key
+
+    def _prune_checkpoints(self):
+        """Forget checkpoints that only lead to messages older than the window"""
+        first = self.oldest_recoverable // CHAIN_CHECKPOINT_INTERVAL
+        for position in [p for p in self.checkpoints if p < first]:
+            del self.checkpoints[position]
+
+    def next_key(self):
+        """Key for the next outgoing message; returns (message_number, key)"""
+        return self._advance()
+
+    def key_for(self, n):
+        """Key for message ``n``, caching any keys skipped on the way"""
+        message_key = self.message_keys.get(n)
+        if message_key is not None:
+            self.message_keys.move_to_end(n)
+            return message_key
+        if n < self.index:
+            if n < self.oldest_recoverable:
+                raise ValueError(f"Key for message {n} is no longer kept")
+            # Evicted from the cache: re-derive from the checkpoint before it
+            chain_key = self.checkpoints[n // CHAIN_CHECKPOINT_INTERVAL]
+            for _ in range(n % CHAIN_CHECKPOINT_INTERVAL + 1):
+                chain_key, message_key = kdf_chain_step(chain_key)
+            self._remember(n, message_key)
+            return message_key
+        if n - self.index >= MAX_SKIP:
+            raise ValueError(f"Message {n} is more than {MAX_SKIP} messages ahead of the chain")
+        while self.index <= n:
+            _, message_key = self._advance()
+        return message_key
 
 class DoubleRatchet:
-    def __init__(self):
-        self.dh_pair = x25519.X25519PrivateKey.generate()
+    def __init__(self, dh_pair=None):
+        self.dh_pair = dh_pair or x25519.X25519PrivateKey.generate()
         self.root_key = None
-        self.send_chain_key = None
-        self.recv_chain_key = None
-        self.prev_sending_keys = []
-        self.message_numbers = {'send': 0, 'recv': 0}
+        self.send_chain = None
+        self.recv_chain = None
     
     def dh(self, their_public):
         return self.dh_pair.exchange(their_public)
 
+    def init_chains(self, own_id, their_id):
+        """Derive a separate sending and receiving chain from the root key"""
+        self.send_chain = KDFChain(self._chain_seed(own_id, their_id))
+        self.recv_chain = KDFChain(self._chain_seed(their_id, own_id))
+
+    def _chain_seed(self, sender_id, receiver_id):
+        h = hmac.HMAC(self.root_key, hashes.SHA256())
+        h.update(f'E2EE-Chat-Chain:{sender_id}:{receiver_id}'.encode())
+        return h.finalize()
+
 class E2EEncryption:
-    def __init__(self, user_id):
+    def __init__(self, user_id, keystore=None):
         self.user_id = user_id
-        self.identity_key = ed25519.Ed25519PrivateKey.generate()
-        self.signed_pre_key = x25519.X25519PrivateKey.generate()
-        self.one_time_pre_keys = [x25519.X25519PrivateKey.generate() for _ in range(20)]
+        self.keystore = keystore
+        # Sessions in use; others stay in the keystore until first needed
         self.sessions = {}
+        self._lock = threading.RLock()
         self.performance_metrics = {
             'encryption_times': [],
             'decryption_times': [],
             'key_generation_times': []
         }
+        
+        identity = keystore.load_identity() if keystore else None
+        if identity:
+            self.identity_key = ed25519.Ed25519PrivateKey.from_private_bytes(identity[0])
+            self.signed_pre_key = x25519.X25519PrivateKey.from_private_bytes(identity[1])
+        else:
+            self.identity_key = ed25519.Ed25519PrivateKey.generate()
+            self.signed_pre_key = x25519.X25519PrivateKey.generate()
+            if keystore:
+                keystore.save_identity(_raw_private(self.identity_key), _raw_private(self.signed_pre_key))
+        self.one_time_pre_keys = [
+            x25519.X25519PrivateKey.from_private_bytes(key) for key in keystore.load_pre_keys()
+        ] if keystore else []
+        self._refill_thread = threading.Thread(target=self.refill_pre_keys, daemon=True)
+        self._refill_thread.start()
+
+    def close(self):
+        """Close the keystore once the background pre-key refill has finished writing to it"""
+        self._refill_thread.join()
+        if self.keystore:
+            self.keystore.close()
+    
+    def refill_pre_keys(self):
+        """Generate one-time pre-keys until the pool holds PRE_KEY_POOL_SIZE"""
+        missing = PRE_KEY_POOL_SIZE - len(self.one_time_pre_keys)
+        if missing <= 0:
+            return
+        keys = [x25519.X25519PrivateKey.generate() for _ in range(missing)]
+        try:
+            if self.keystore:
+                self.keystore.add_pre_keys([_raw_private(key) for key in keys])
+        except Exception as e:
+            print(f"Error storing pre-keys: {e}")
+            return
+        self.one_time_pre_keys = self.one_time_pre_keys + keys
     
     def get_public_bundle(self):
         """Get public key bundle for initial key exchange"""
         start_time = time.time()
         bundle = {
-            'identity_key': b64encode(self.identity_key.public_key().public_bytes()).decode(),
-            'signed_pre_key': b64encode(self.signed_pre_key.public_key().public_bytes()).decode(),
+            'identity_key': b64encode(_raw_public(self.identity_key.public_key())).decode(),
+            'signed_pre_key': b64encode(_raw_public(self.signed_pre_key.public_key())).decode(),
             'one_time_pre_keys': [
-                b64encode(key.public_key().public_bytes()).decode()
+                b64encode(_raw_public(key.public_key())).decode()
                 for key in self.one_time_pre_keys
             ]
         }
         self.performance_metrics['key_generation_times'].append(time.time() - start_time)
         return bundle
     
+    def _session(self, peer_id):
+        """A peer's session, loaded from the keystore the first time it is used; None if there is none"""
+        session = self.sessions.get(peer_id)
+        if session is None and self.keystore:
+            state = self.keystore.load_session(peer_id)
+            if state:
+                ratchet = DoubleRatchet(x25519.X25519PrivateKey.from_private_bytes(state['dh_key']))
+                ratchet.root_key = state['root_key']
+                ratchet.send_chain = KDFChain.restore(*state['chains']['send'])
+                ratchet.recv_chain = KDFChain.restore(*state['chains']['recv'])
+                session = self.sessions.setdefault(peer_id, {
+                    'ratchet': ratchet,
+                    'their_identity': ed25519.Ed25519PublicKey.from_public_bytes(state['their_identity'])
+                })
+        return session
+
+    def has_session(self, peer_id):
+        return self._session(peer_id) is not None
+
+    def _message_key(self, peer_id, direction, message_number=None):
+        """(message_number, key) from a session's 'send' or 'recv' chain.
+
+        Without a message number the chain steps to its next key. A chain that
+        moved is written back to the keystore.
+        """
+        session = self._session(peer_id)
+        if session is None:
+            raise ValueError("No session established with this peer")
+        chain = getattr(session['ratchet'], f'{direction}_chain')
+        with self._lock:
+            old_index = chain.index
+            if message_number is None:
+                message_number, message_key = chain.next_key()
+            else:
+                message_key = chain.key_for(message_number)
+            if self.keystore and chain.index != old_index:
+                first = old_index // CHAIN_CHECKPOINT_INTERVAL + 1
+                self.keystore.save_chain(peer_id, direction, chain.index, chain.chain_key,
+                                         [(position, key) for position, key in chain.checkpoints.items()
+                                          if position >= first],
+                                         min(chain.checkpoints))
+        return message_number, message_key
+
     def initialize_session(self, their_bundle, their_id):
         """Initialize a new session with another user"""
-        if their_id in self.sessions:
+        if self.has_session(their_id):
             return
         
         start_time = time.time()
@@ -72,74 +384,52 @@ class E2EEncryption:
             salt=None,
             info=b'E2EE-Chat-Initial-Root-Key'
         ).derive(dh_result)
+        ratchet.init_chains(self.user_id, their_id)
         
         self.sessions[their_id] = {
             'ratchet': ratchet,
             'their_identity': their_identity
         }
+        if self.keystore:
+            self.keystore.save_session(
+                their_id, _raw_private(ratchet.dh_pair), ratchet.root_key, _raw_public(their_identity),
+                {'send': ratchet.send_chain.state(), 'recv': ratchet.recv_chain.state()}
+            )
         
         self.performance_metrics['key_generation_times'].append(time.time() - start_time)
     
     def encrypt_message(self, message, recipient_id):
         """Encrypt a message for a specific recipient"""
-        if recipient_id not in self.sessions:
+        if not self.has_session(recipient_id):
             raise ValueError("No session established with this recipient")
         
         start_time = time.time()
         
-        session = self.sessions[recipient_id]
-        ratchet = session['ratchet']
-        
-        # Generate message key
-        message_key = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=None,
-            info=b'E2EE-Chat-Message-Key'
-        ).derive(ratchet.root_key + str(ratchet.message_numbers['send']).encode())
+        # Step the sending chain for this message's key
+        message_number, message_key = self._message_key(recipient_id, 'send')
         
         # Encrypt message
         aesgcm = AESGCM(message_key)
         nonce = os.urandom(12)
         ciphertext = aesgcm.encrypt(nonce, message.encode(), None)
         
-        # Create encrypted message package
-        encrypted_message = {
-            'ciphertext': b64encode(ciphertext).decode(),
-            'nonce': b64encode(nonce).decode(),
-            'message_number': ratchet.message_numbers['send']
-        }
-        
-        # Update ratchet state
-        ratchet.message_numbers['send'] += 1
+        encrypted_message = pack_envelope(message_number, nonce, ciphertext)
         
         self.performance_metrics['encryption_times'].append(time.time() - start_time)
         
-        return json.dumps(encrypted_message)
+        return encrypted_message
     
     def decrypt_message(self, encrypted_message, sender_id):
         """Decrypt a message from a specific sender"""
-        if sender_id not in self.sessions:
+        if not self.has_session(sender_id):
             raise ValueError("No session established with this sender")
         
         start_time = time.time()
         
-        session = self.sessions[sender_id]
-        ratchet = session['ratchet']
+        message_number, nonce, ciphertext = unpack_envelope(encrypted_message)
         
-        # Parse encrypted message
-        message_data = json.loads(encrypted_message)
-        ciphertext = b64decode(message_data['ciphertext'])
-        nonce = b64decode(message_data['nonce'])
-        message_number = message_data['message_number']
-        
-        # Generate message key
-        message_key = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=None,
-            info=b'E2EE-Chat-Message-Key'
-        ).derive(ratchet.root_key + str(message_number).encode())
+        # Cached if seen or skipped before, otherwise the receiving chain steps forward to it
+        _, message_key = self._message_key(sender_id, 'recv', message_number)
         
         # Decrypt message
         aesgcm = AESGCM(message_key)
@@ -148,6 +438,62 @@ class E2EEncryption:
         self.performance_metrics['decryption_times'].append(time.time() - start_time)
         
         return plaintext.decode()
+
+    def decrypt_many(self, rows):
+        """Decrypt a page of (encrypted_message, sender_id, receiver_id) rows.
+
+        Keys come from the chains in one serial pass: the receiving chain for
+        messages from the peer, the sending chain for our own. AES-GCM then
+        runs across the decrypt pool. Returns plaintexts in row order, with
+        None for rows that have no session or fail to decrypt.
+        """
+        start_time = time.time()
+        jobs = []
+        # Hold the chains for the whole pass; only the AES-GCM work below runs on other threads
+        with self._lock:
+            for encrypted_message, sender_id, receiver_id in rows:
+                try:
+                    outgoing = sender_id == self.user_id
+                    message_number, nonce, ciphertext = unpack_envelope(encrypted_message)
+                    _, message_key = self._message_key(
+                        receiver_id if outgoing else sender_id, 'send' if outgoing else 'recv', message_number
+                    )
+                    jobs.append((message_key, nonce, ciphertext))
+                except Exception as e:
+                    print(f"Error preparing message for decryption: {e}")
+                    jobs.append(None)
+
+        sealed = [job for job in jobs if job is not None]
+        if len(sealed) < PARALLEL_DECRYPT_MIN:
+            opened = _open_sealed(sealed)
+        else:
+            slices = [sealed[i::DECRYPT_WORKERS] for i in range(DECRYPT_WORKERS)]
+            opened = [None] * len(sealed)
+            for i, plaintexts in enumerate(_decrypt_pool.map(_open_sealed, slices)):
+                opened[i::DECRYPT_WORKERS] = plaintexts
+
+        opened = iter(opened)
+        plaintexts = [None if job is None else next(opened) for job in jobs]
+        if jobs:
+            self.performance_metrics['decryption_times'].append((time.time() - start_time) / len(jobs))
+        return plaintexts
+    
+    def file_encryptor(self, recipient_id):
+        """StreamEncryptor for an attachment, keyed by the next step of the sending chain"""
+        if not self.has_session(recipient_id):
+            raise ValueError("No session established with this recipient")
+        message_number, message_key = self._message_key(recipient_id, 'send')
+        return StreamEncryptor(message_key, message_number)
+
+    def file_decryptor(self, sender_id):
+        """StreamDecryptor for an attachment from a peer, keyed from the receiving chain.
+
+        The stream header's message number is the peer's to choose, so it goes
+        through the same MAX_SKIP check as a chat envelope's.
+        """
+        if not self.has_session(sender_id):
+            raise ValueError("No session established with this sender")
+        return StreamDecryptor(lambda message_number: self._message_key(sender_id, 'recv', message_number)[1])
     
     def get_performance_metrics(self):
         """Get average performance metrics"""
@@ -159,4 +505,23 @@ class E2EEncryption:
             'key_generation_time': sum(self.performance_metrics['key_generation_times']) / len(self.performance_metrics['key_generation_times'])
             if self.performance_metrics['key_generation_times'] else 0
         }
-        return metrics 
\ No newline at end of file
+        return metrics
+
+encryption_manager = None
+
+def init_encryption(user_id, app=None):
+    """Initialize the encryption manager for a user, keeping it if that user already has one.
+
+    With an app, keys and sessions persist in a keystore under KEYSTORE_FOLDER.
+    """
+    global encryption_manager
+    if encryption_manager is not None and encryption_manager.user_id == user_id:
+        return
+    if encryption_manager is not None:
+        encryption_manager.close()
+    keystore = Keystore(os.path.join(app.config['KEYSTORE_FOLDER'], f'{user_id}.db')) if app else None
+    encryption_manager = E2EEncryption(user_id, keystore)
+
+def get_encryption_manager():
+    """Get the current encryption manager instance"""
+    return encryption_manager
@@ -0,0 +1,137 @@
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS identity (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    identity_key BLOB NOT NULL,
+    signed_pre_key BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pre_key (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    private_key BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS session (
+    peer_id INTEGER PRIMARY KEY,
+    dh_key BLOB NOT NULL,
+    root_key BLOB NOT NULL,
+    their_identity BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chain (
+    peer_id INTEGER NOT NULL,
+    direction TEXT NOT NULL,
+    chain_index INTEGER NOT NULL,
+    chain_key BLOB NOT NULL,
+    PRIMARY KEY (peer_id, direction)
+);
+CREATE TABLE IF NOT EXISTS checkpoint (
+    peer_id INTEGER NOT NULL,
+    direction TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    chain_key BLOB NOT NULL,
+    PRIMARY KEY (peer_id, direction, position)
+);
+"""
+
+class Keystore:
+    """One user's identity, pre-keys and ratchet sessions in a SQLite file.
+
+    Only raw key bytes pass through here; E2EEncryption turns them back into
+    key objects. Sessions are read one peer at a time, and a chain is written
+    back as a single row update each time it advances, plus a checkpoint row
+    every CHAIN_CHECKPOINT_INTERVAL steps. Checkpoints that fall out of the
+    chain's window are deleted in the same transaction, with secure_delete
+    so their bytes are overwritten.
+
+    Keys are stored unencrypted, protected only by the file's 0600 mode.
+    Whoever can read the file can decrypt each session's last
+    MAX_CACHED_MESSAGE_KEYS messages per direction and every later message
+    until the session is replaced. Older pages may also linger in the WAL
+    file until its next checkpoint.
+    """
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        os.chmod(path, 0o600)  # Private keys are stored unencrypted
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('PRAGMA secure_delete=ON')
+        self._db.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def load_identity(self):
+        """(identity_key, signed_pre_key) private bytes, or None for a new store"""
+        with self._lock:
+            return self._db.execute('SELECT identity_key, signed_pre_key FROM identity').fetchone()
+
+    def save_identity(self, identity_key, signed_pre_key):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO identity VALUES (1, ?, ?)', (identity_key, signed_pre_key))
+
+    def load_pre_keys(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT private_key FROM pre_key ORDER BY id')]
+
+    def add_pre_keys(self, private_keys):
+        with self._lock, self._db:
+            self._db.executemany('INSERT INTO pre_key (private_key) VALUES (?)', [(key,) for key in private_keys])
+
+    def load_session(self, peer_id):
+        """A peer's session as raw state, or None if there is none.
+
+        Returns {'dh_key', 'root_key', 'their_identity', 'chains'} where chains
+        maps 'send' and 'recv' to (index, chain_key, {position: chain_key}).
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT dh_key, root_key, their_identity FROM session WHERE peer_id = ?', (peer_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            chains = {}
+            for direction, index, chain_key in self._db.execute(
+                'SELECT direction, chain_index, chain_key FROM chain WHERE peer_id = ?', (peer_id,)
+            ):
+                checkpoints = dict(self._db.execute(
+                    'SELECT position, chain_key FROM checkpoint WHERE peer_id = ? AND direction = ?',
+                    (peer_id, direction)
+                ))
+                chains[direction] = (index, chain_key, checkpoints)
+        dh_key, root_key, their_identity = row
+        return {'dh_key': dh_key, 'root_key': root_key, 'their_identity': their_identity, 'chains': chains}
+
+    def save_session(self, peer_id, dh_key, root_key, their_identity, chains):
+        """Store a whole session, replacing any previous one with the peer"""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM checkpoint WHERE peer_id = ?', (peer_id,))
+            self._db.execute('INSERT OR REPLACE INTO session VALUES (?, ?, ?, ?)',
+                             (peer_id, dh_key, root_key, their_identity))
+            for direction, (index, chain_key, checkpoints) in chains.items():
+                self._write_chain(peer_id, direction, index, chain_key, checkpoints.items())
+
+    def save_chain(self, peer_id, direction, index, chain_key, new_checkpoints, first_position):
+        """Write back an advanced chain.
+
+        ``new_checkpoints`` are (position, chain_key) pairs; stored checkpoints
+        before ``first_position`` are deleted.
+        """
+        with self._lock, self._db:
+            self._write_chain(peer_id, direction, index, chain_key, new_checkpoints)
+            if new_checkpoints:
+                self._db.execute(
+                    'DELETE FROM checkpoint WHERE peer_id = ? AND direction = ? AND position < ?',
+                    (peer_id, direction, first_position)
+                )
+
+    def _write_chain(self, peer_id, direction, index, chain_key, checkpoints):
+        self._db.execute('INSERT OR REPLACE INTO chain VALUES (?, ?, ?, ?)', (peer_id, direction, index, chain_key))
+        self._db.executemany(
+            'INSERT OR IGNORE INTO checkpoint VALUES (?, ?, ?, ?)',
+            [(peer_id, direction, position, key) for position, key in checkpoints]
+        )
@@ -1,15 +1,25 @@
 import os
 from datetime import datetime, timedelta
-from flask import render_template, flash, redirect, url_for, request, jsonify, current_app, send_from_directory
+from flask import render_template, flash, redirect, url_for, request, jsonify, current_app, send_from_directory, send_file, abort, g
 from flask_login import current_user, login_required
+from flask_socketio import join_room
 from werkzeug.utils import secure_filename
-from app import db, socketio
+from app import db, socketio, uploads, blobstore, thumbnails
 from app.main import bp
-from app.models import User, Contact, Message
+from app.models import User, Contact, Message, Conversation, MessageDailyStats, Upload, add_message
 from app.network import get_network_manager
+from app.encryption import get_encryption_manager
+from app.outbox import outbox
+from app.pipeline import message_writer
 import json
+import math
+import uuid
+import hashlib
 import numpy as np
 
+# Shown in place of an encrypted message this device cannot decrypt
+UNDECRYPTABLE_MESSAGE = '[Unable to decrypt this message]'
+
 def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
@@ -18,7 +28,29 @@ def allowed_file(filename, allowed_extensions):
 @login_required
 def index():
     contacts = Contact.query.filter_by(user_id=current_user.id).all()
-    return render_template('main/index.html', title='Home', contacts=contacts)
+
+    # One pass over the user's conversations, keyed by the peer's phone number
+    peer_id = db.case(
+        (Conversation.user_low_id == current_user.id, Conversation.user_high_id),
+        else_=Conversation.user_low_id
+    )
+    conversations = dict(
+        db.session.query(User.phone_number, Conversation)
+        .join(User, User.id == peer_id)
+        .filter(Conversation.involving(current_user.id))
+        .options(db.joinedload(Conversation.last_message))
+        .all()
+    )
+
+    # Most recently active chats first
+    contacts.sort(
+        key=lambda c: conversations[c.contact_phone].last_activity
+        if c.contact_phone in conversations and conversations[c.contact_phone].last_activity
+        else datetime.min,
+        reverse=True
+    )
+    return render_template('main/index.html', title='Home', contacts=contacts,
+                           conversations=conversations)
 
 @bp.route('/get_contact_details/<phone_number>')
 @login_required
@@ -29,6 +61,36 @@ def get_contact_details(phone_number):
         'display_name': contact_user.display_name
     })
 
+@bp.route('/get_contact_statuses')
+@login_required
+def get_contact_statuses():
+    """Display names and online status for all of the user's contacts at once.
+
+    Responses carry an ETag over their content, so polls that see no change
+    are answered with 304 Not Modified.
+    """
+    rows = db.session.query(Contact.contact_phone, User.display_name).outerjoin(
+        User, User.phone_number == Contact.contact_phone
+    ).filter(Contact.user_id == current_user.id).all()
+
+    network_mgr = get_network_manager()
+    peers = network_mgr.peers if network_mgr else {}
+
+    statuses = {
+        phone: {
+            'display_name': display_name,
+            'online_status': phone in peers
+        }
+        for phone, display_name in rows
+    }
+
+    body = json.dumps({'contacts': statuses}, sort_keys=True)
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body.encode()).hexdigest())
+    # Let the browser keep the body but revalidate it on every poll
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @bp.route('/add_contact', methods=['POST'])
 @login_required
 def add_contact():
@@ -66,83 +128,112 @@ def add_contact():
 @bp.route('/get_messages/<phone_number>')
 @login_required
 def get_messages(phone_number):
+    """Return one page of the conversation with a contact, oldest first.
+
+    Pages are keyed on (timestamp, id) rather than offsets: ``before_id``
+    walks back into older history and ``after_id`` fetches messages newer
+    than the given one. Without a cursor the most recent page is returned.
+    """
     contact = User.query.filter_by(phone_number=phone_number).first_or_404()
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == contact.id)) |
-        ((Message.sender_id == contact.id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.timestamp.asc()).all()
-    
-    return jsonify([{
-        'id': msg.id,
-        'content': msg.content,
-        'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-        'is_sender': msg.sender_id == current_user.id,
-        'is_file': msg.is_file,
-        'file_name': msg.file_name if msg.is_file else None,
-        'file_type': msg.file_type if msg.is_file else None
-    } for msg in messages])
+    before_id = request.args.get('before_id', type=int)
+    after_id = request.args.get('after_id', type=int)
+    limit = request.args.get('limit', current_app.config['MESSAGES_PER_PAGE'], type=int)
+    limit = max(1, min(limit, current_app.config['MAX_MESSAGES_PER_PAGE']))
 
-@bp.route('/upload_file', methods=['POST'])
-@login_required
-def upload_file():
-    if 'file' not in request.files:
-        return jsonify({'success': False, 'message': 'No file part'})
-    
-    file = request.files['file']
-    receiver_phone = request.form.get('receiver_phone')
-    
-    if not file or not file.filename:
-        return jsonify({'success': False, 'message': 'No file selected'})
-    
-    receiver = User.query.filter_by(phone_number=receiver_phone).first()
-    if not receiver:
-        return jsonify({'success': False, 'message': 'Receiver not found'})
-    
-    filename = secure_filename(file.filename)
+    conversation = Conversation.find(current_user.id, contact.id)
+    if conversation is None:
+        return jsonify({'messages': [], 'has_more': False})
+
+    thread = Message.query.filter(Message.conversation_id == conversation.id)
+    page_key = db.tuple_(Message.timestamp, Message.id)
+
+    cursor_id = after_id or before_id
+    if cursor_id:
+        cursor = thread.filter(Message.id == cursor_id).with_entities(
+            Message.timestamp, Message.id
+        ).first_or_404()
+
+    if after_id:
+        query = thread.filter(page_key > tuple(cursor)).order_by(
+            Message.timestamp.asc(), Message.id.asc()
+        )
+    else:
+        query = thread
+        if before_id:
+            query = query.filter(page_key < tuple(cursor))
+        query = query.order_by(Message.timestamp.desc(), Message.id.desc())
+
+    # Fetch one extra row to learn whether another page exists
+    messages = query.limit(limit + 1).all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not after_id:
+        messages.reverse()
+
+    # Decrypt the whole page in one batch rather than row by row
+    plaintexts = {}
+    encryption_mgr = get_encryption_manager()
+    if encryption_mgr and encryption_mgr.user_id == current_user.id:
+        plaintexts = Message.decrypt_contents(messages, encryption_mgr)
+
+    return jsonify({
+        'messages': [{
+            'id': msg.id,
+            'content': plaintexts.get(msg.id, msg.content) or (UNDECRYPTABLE_MESSAGE if msg.encrypted_content else msg.content),
+            'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            'is_sender': msg.sender_id == current_user.id,
+            'status': msg.status_label,
+            'is_file': msg.is_file,
+            'file_name': msg.file_name if msg.is_file else None,
+            'file_type': msg.file_type if msg.is_file else None
+        } for msg in messages],
+        'has_more': has_more
+    })
+
+def get_file_type(filename):
+    """Classify an upload as 'image' or 'file', or None if its extension is not allowed"""
     file_ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
     
     if file_ext in current_app.config['ALLOWED_IMAGE_EXTENSIONS']:
-        file_type = 'image'
+        return 'image'
     elif file_ext in current_app.config['ALLOWED_FILE_EXTENSIONS']:
-        file_type = 'file'
-    else:
-        return jsonify({'success': False, 'message': 'File type not allowed'})
-    
-    # Create upload directory if it doesn't exist
-    if not os.path.exists(current_app.config['UPLOAD_FOLDER']):
-        os.makedirs(current_app.config['UPLOAD_FOLDER'])
-    
-    # Save file
-    file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-    file.save(file_path)
+        return 'file'
+    return None
+
+def share_file(receiver, filename, file_type, sha256):
+    """Record a blob-stored upload as a file message and deliver it"""
+    stored_name = blobstore.blob_name(sha256, filename)
     
     # Create message
     message = Message(
         sender_id=current_user.id,
         receiver_id=receiver.id,
-        content=filename,  # Store just the filename
+        content=stored_name,  # Name the file is served under
         is_file=True,
         file_type=file_type,
-        file_name=filename
+        file_name=filename,
+        blob_sha256=sha256
     )
-    db.session.add(message)
+    add_message(message)
     db.session.commit()
     
-    # Try to send file over network
+    if file_type == 'image':
+        thumbnails.schedule(blobstore.blob_path(sha256), current_app.config['THUMBNAIL_SIZES'])
+    
+    # Stream the file itself to the peer when it is on the LAN
     network_mgr = get_network_manager()
     if network_mgr:
-        network_mgr.send_message(receiver_phone, {
-            'type': 'file',
+        network_mgr.send_file(receiver.phone_number, blobstore.blob_path(sha256), {
             'filename': filename,
             'file_type': file_type,
-            'content': filename  # Send filename instead of content
+            'sha256': sha256
         }, message.id)
     
     # Emit message event
     socketio.emit('new_message', {
         'message': {
             'id': message.id,
-            'content': filename,
+            'content': stored_name,
             'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
             'sender_phone': current_user.phone_number,
             'receiver_phone': receiver.phone_number,
@@ -150,7 +241,174 @@ def upload_file():
             'file_type': file_type,
             'file_name': filename
         }
+    }, to=[current_user.room, receiver.room])
+    
+    return message
+
+@bp.route('/upload_file', methods=['POST'])
+@login_required
+def upload_file():
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'message': 'No file part'})
+    
+    file = request.files['file']
+    receiver_phone = request.form.get('receiver_phone')
+    
+    if not file or not file.filename:
+        return jsonify({'success': False, 'message': 'No file selected'})
+    
+    receiver = User.query.filter_by(phone_number=receiver_phone).first()
+    if not receiver:
+        return jsonify({'success': False, 'message': 'Receiver not found'})
+    
+    filename = secure_filename(file.filename)
+    file_type = get_file_type(filename)
+    if not file_type:
+        return jsonify({'success': False, 'message': 'File type not allowed'})
+    
+    # Store by content; identical files share one copy on disk
+    sha256, size = blobstore.put_stream(file.stream)
+    
+    message = share_file(receiver, filename, file_type, sha256)
+    
+    return jsonify({
+        'success': True,
+        'message': 'File uploaded successfully',
+        'file_info': {
+            'id': message.id,
+            'filename': filename,
+            'file_type': file_type,
+            'sha256': sha256
+        }
     })
+
+def _upload_status(upload):
+    return {
+        'upload_id': upload.id,
+        'size': upload.size,
+        'chunk_size': upload.chunk_size,
+        'chunk_count': upload.chunk_count,
+        'received': upload.received_chunks
+    }
+
+def _can_access_blob(sha256):
+    """Whether the current user is a party to a message carrying the blob"""
+    return db.session.query(Message.query.filter(
+        (Message.blob_sha256 == sha256) &
+        ((Message.sender_id == current_user.id) | (Message.receiver_id == current_user.id))
+    ).exists()).scalar()
+
+@bp.route('/upload_sessions', methods=['POST'])
+@login_required
+def init_upload():
+    """Start a resumable upload: the client then PUTs each chunk and finalizes"""
+    data = request.get_json(silent=True) or {}
+    filename = secure_filename(data.get('filename') or '')
+    size = data.get('size')
+    
+    if not filename:
+        return jsonify({'success': False, 'message': 'No file selected'})
+    
+    if not isinstance(size, int) or size < 0 or size > current_app.config['MAX_UPLOAD_SIZE']:
+        return jsonify({'success': False, 'message': 'Invalid file size'})
+    
+    receiver = User.query.filter_by(phone_number=data.get('receiver_phone')).first()
+    if not receiver:
+        return jsonify({'success': False, 'message': 'Receiver not found'})
+    
+    file_type = get_file_type(filename)
+    if not file_type:
+        return jsonify({'success': False, 'message': 'File type not allowed'})
+    
+    # Known content needs no transfer, but only for content the caller already has:
+    # the client's digest alone proves nothing about possessing the bytes
+    sha256 = (data.get('sha256') or '').lower() or None
+    if sha256 and blobstore.exists(sha256) and _can_access_blob(sha256):
+        message = share_file(receiver, filename, file_type, sha256)
+        return jsonify({
+            'success': True,
+            'deduplicated': True,
+            'message': 'File uploaded successfully',
+            'file_info': {
+                'id': message.id,
+                'filename': filename,
+                'file_type': file_type,
+                'sha256': sha256
+            }
+        })
+    
+    uploads.expire_stale(current_app.config['UPLOAD_SESSION_TTL'])
+    if Upload.query.filter_by(user_id=current_user.id).count() >= current_app.config['MAX_OPEN_UPLOADS']:
+        return jsonify({'success': False, 'message': 'Too many uploads in progress'}), 429
+    
+    chunk_size = current_app.config['UPLOAD_CHUNK_SIZE']
+    upload = Upload(
+        id=uuid.uuid4().hex,
+        user_id=current_user.id,
+        receiver_id=receiver.id,
+        file_name=filename,
+        file_type=file_type,
+        size=size,
+        chunk_size=chunk_size,
+        received='0' * max(1, math.ceil(size / chunk_size)),
+        sha256=sha256
+    )
+    uploads.preallocate(upload)
+    db.session.add(upload)
+    db.session.commit()
+    
+    return jsonify({'success': True, **_upload_status(upload)})
+
+def _get_upload(upload_id):
+    return Upload.query.filter_by(id=upload_id, user_id=current_user.id).first_or_404()
+
+@bp.route('/upload_sessions/<upload_id>')
+@login_required
+def upload_status(upload_id):
+    """Report which chunks have arrived, so an interrupted upload can resume"""
+    return jsonify({'success': True, **_upload_status(_get_upload(upload_id))})
+
+@bp.route('/upload_sessions/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    upload = _get_upload(upload_id)
+    if index >= upload.chunk_count:
+        return jsonify({'success': False, 'message': 'Chunk out of range'}), 416
+    
+    if not upload.has_chunk(index):
+        if not uploads.write_chunk(upload, index, request.stream):
+            return jsonify({'success': False, 'message': 'Incomplete chunk'}), 400
+        upload.mark_received(index)
+        db.session.commit()
+        uploads.advance_hash(upload)
+    
+    return jsonify({'success': True, 'received': index})
+
+@bp.route('/upload_sessions/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    upload = _get_upload(upload_id)
+    if not upload.complete:
+        return jsonify({
+            'success': False,
+            'message': 'Upload incomplete',
+            'missing': [i for i in range(upload.chunk_count) if not upload.has_chunk(i)]
+        }), 409
+    
+    # Claim the session before touching its file; a concurrent or retried finalize gets a 404
+    receiver, filename, file_type = upload.receiver, upload.file_name, upload.file_type
+    db.session.expunge(upload)  # Keep its loaded fields for the file work below
+    if not Upload.query.filter_by(id=upload.id, user_id=current_user.id).delete():
+        abort(404)
+    db.session.commit()
+    
+    sha256 = uploads.finish_hash(upload)
+    if upload.sha256 and upload.sha256 != sha256:
+        uploads.discard(upload)
+        return jsonify({'success': False, 'message': 'Checksum mismatch'}), 422
+    
+    blobstore.put_file(uploads.partial_path(upload), sha256, upload.size)
+    message = share_file(receiver, filename, file_type, sha256)
     
     return jsonify({
         'success': True,
@@ -158,7 +416,8 @@ def upload_file():
         'file_info': {
             'id': message.id,
             'filename': filename,
-            'file_type': file_type
+            'file_type': file_type,
+            'sha256': sha256
         }
     })
 
@@ -175,8 +434,60 @@ def refresh_connections():
 @bp.route('/uploads/<filename>')
 @login_required
 def uploaded_file(filename):
-    """Serve uploaded files"""
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    """Serve uploaded files from the blob store, falling back to legacy flat uploads"""
+    sha256 = blobstore.parse_blob_name(filename)
+    if sha256 is None:
+        return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    
+    # Only parties to a message carrying the blob may fetch it
+    shared = Message.query.filter(
+        (Message.blob_sha256 == sha256) &
+        ((Message.sender_id == current_user.id) | (Message.receiver_id == current_user.id))
+    ).first()
+    if not shared:
+        abort(404)
+    return blobstore.send_blob(sha256, shared.file_name or filename)
+
+@bp.route('/thumbs/<int:message_id>/<size>')
+@login_required
+def thumbnail(message_id, size):
+    """Serve a downscaled image attachment, rendering it on first request"""
+    max_px = current_app.config['THUMBNAIL_SIZES'].get(size)
+    message = Message.query.filter(
+        (Message.id == message_id) & (Message.is_file == True) & (Message.file_type == 'image') &
+        ((Message.sender_id == current_user.id) | (Message.receiver_id == current_user.id))
+    ).first()
+    if not message or not max_px:
+        abort(404)
+    
+    if not thumbnails.available():
+        return redirect(url_for('main.uploaded_file', filename=message.content))
+    
+    if message.blob_sha256:
+        original_path = blobstore.blob_path(message.blob_sha256)
+    else:
+        # Uploads from before the blob store sit flat in UPLOAD_FOLDER
+        original_path = os.path.join(current_app.config['UPLOAD_FOLDER'], secure_filename(message.content))
+    if not os.path.exists(original_path):
+        abort(404)
+    
+    try:
+        path = thumbnails.ensure(original_path, size, max_px)
+    except Exception as e:
+        print(f"Error rendering thumbnail for message {message_id}: {e}")
+        return redirect(url_for('main.uploaded_file', filename=message.content))
+    return send_file(path, mimetype='image/jpeg', max_age=current_app.config['THUMBNAIL_MAX_AGE'])
+
+@socketio.on('connect')
+def handle_connect():
+    """Subscribe the connection to its user's room and its contacts' presence rooms"""
+    if not current_user.is_authenticated:
+        return False
+    join_room(current_user.room)
+
+    # Presence events for each contact are pushed to these rooms by the NetworkManager
+    for contact in Contact.query.filter_by(user_id=current_user.id).all():
+        join_room(User.presence_room(contact.contact_phone))
 
 @socketio.on('send_message')
 def handle_message(data):
@@ -188,24 +499,60 @@ def handle_message(data):
             receiver_id=receiver.id,
             content=data['message']
         )
-        db.session.add(message)
+        # With a LAN transport running, the outbox sends it until the peer acks
+        lan_delivery = get_network_manager() is not None
+        if lan_delivery:
+            message.queue_for_delivery()
+        sender_phone, sender_room = current_user.phone_number, current_user.room
+        receiver_phone, receiver_room = receiver.phone_number, receiver.room
+
+        def deliver(message):
+            if lan_delivery:
+                outbox.notify()
+            
+            # Emit message event
+            socketio.emit('new_message', {
+                'message': {
+                    'id': message.id,
+                    'content': message.content,
+                    'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                    'sender_phone': sender_phone,
+                    'receiver_phone': receiver_phone,
+                    'status': message.status_label
+                }
+            }, to=[sender_room, receiver_room])
+
+        def fail(message):
+            # Only the sender saw the message; tell them it was not stored
+            socketio.emit('message_failed', {
+                'receiver_phone': receiver_phone,
+                'content': message.content
+            }, to=sender_room)
+
+        # With group commit enabled, the writer delivers once the batch is durable
+        if message_writer.running:
+            message_writer.submit(message, deliver, fail)
+            return
+
+        add_message(message)
         db.session.commit()
-        
-        # Try to send message over network
-        network_mgr = get_network_manager()
-        if network_mgr:
-            network_mgr.send_message(data['receiver_phone'], data['message'], message.id)
-        
-        # Emit message event
-        socketio.emit('new_message', {
-            'message': {
-                'id': message.id,
-                'content': message.content,
-                'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-                'sender_phone': current_user.phone_number,
-                'receiver_phone': receiver.phone_number
-            }
-        })
+        deliver(message)
+
+@bp.route('/pipeline_metrics')
+@login_required
+def pipeline_metrics():
+    """Batch-size and latency metrics of the group-commit message writer"""
+    return jsonify({
+        'enabled': message_writer.running,
+        **message_writer.get_performance_metrics()
+    })
+
+@bp.route('/network_peers')
+@login_required
+def network_peers():
+    """Discovered LAN peers with last-seen times, TTLs and address history"""
+    network_mgr = get_network_manager()
+    return jsonify({'peers': network_mgr.peer_cache.records() if network_mgr else {}})
 
 @bp.route('/security-analysis')
 @login_required
@@ -222,27 +569,49 @@ def security_analysis():
                          encryption_metrics=encryption_metrics,
                          security_score=security_score)
 
+def get_message_aggregates():
+    """Per-day message counts for the current user over the last 30 days.
+
+    Counts come from the MessageDailyStats rollup, so this reads at most 31
+    small rows regardless of history size. The result is cached on ``g`` so
+    every dashboard helper in the same request shares it.
+    """
+    if 'message_aggregates' in g:
+        return g.message_aggregates
+
+    since = datetime.now().date() - timedelta(days=30)
+    rows = MessageDailyStats.query.filter(
+        (MessageDailyStats.user_id == current_user.id) &
+        (MessageDailyStats.day >= since)
+    ).all()
+    total_messages = db.session.query(db.func.sum(MessageDailyStats.total)).filter(
+        MessageDailyStats.user_id == current_user.id
+    ).scalar()
+
+    g.message_aggregates = {
+        'total_messages': total_messages or 0,
+        'daily': {
+            row.day: {name: getattr(row, name) for name in MessageDailyStats.COUNTERS}
+            for row in rows
+        }
+    }
+    return g.message_aggregates
+
+def _sum_daily(daily, field):
+    return sum(counts[field] for counts in daily.values())
+
 def get_encryption_metrics():
     """Calculate real encryption metrics"""
-    total_messages = Message.query.filter(
-        (Message.sender_id == current_user.id) | 
-        (Message.receiver_id == current_user.id)
-    ).count()
-    
-    # Get messages from last 30 days
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    recent_messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) | (Message.receiver_id == current_user.id)) &
-        (Message.timestamp >= thirty_days_ago)
-    ).all()
-    
+    aggregates = get_message_aggregates()
+    recent_messages = _sum_daily(aggregates['daily'], 'total')
+    encrypted_count = _sum_daily(aggregates['daily'], 'encrypted')
+
     # Calculate encryption success rate
-    encrypted_count = sum(1 for msg in recent_messages if msg.is_encrypted)
-    encryption_rate = (encrypted_count / len(recent_messages) * 100) if recent_messages else 100
+    encryption_rate = (encrypted_count / recent_messages * 100) if recent_messages else 100
     
     return {
-        'total_messages': total_messages,
-        'recent_messages': len(recent_messages),
+        'total_messages': aggregates['total_messages'],
+        'recent_messages': recent_messages,
         'encryption_rate': round(encryption_rate, 2)
     }
 
@@ -250,22 +619,14 @@ def calculate_security_score():
     """Calculate overall security score based on multiple factors"""
     # Get base metrics
     encryption_metrics = get_encryption_metrics()
+    daily = get_message_aggregates()['daily']
     
     # Calculate component scores
     encryption_score = encryption_metrics['encryption_rate']
     
     # Network security score based on successful message delivery
-    thirty_days_ago = datetime.now() - timedelta(days=30)
-    delivered_messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) | (Message.receiver_id == current_user.id)) &
-        (Message.timestamp >= thirty_days_ago) &
-        (Message.status == 'DELIVERED')
-    ).count()
-    
-    total_recent = Message.query.filter(
-        ((Message.sender_id == current_user.id) | (Message.receiver_id == current_user.id)) &
-        (Message.timestamp >= thirty_days_ago)
-    ).count()
+    delivered_messages = _sum_daily(daily, 'delivered')
+    total_recent = encryption_metrics['recent_messages']
     
     network_score = (delivered_messages / total_recent * 100) if total_recent > 0 else 100
     
@@ -281,46 +642,32 @@ def calculate_security_score():
 
 def get_message_statistics():
     """Get detailed message statistics for the last 7 days"""
+    daily = get_message_aggregates()['daily']
+    empty = {'total': 0, 'sent': 0, 'delivered': 0, 'encrypted': 0}
     stats = []
     today = datetime.now().date()
     
     for i in range(7):
         date = today - timedelta(days=i)
-        next_date = date + timedelta(days=1)
-        
-        # Get messages for this day
-        days_messages = Message.query.filter(
-            ((Message.sender_id == current_user.id) | (Message.receiver_id == current_user.id)) &
-            (Message.timestamp >= date) &
-            (Message.timestamp < next_date)
-        ).all()
-        
-        sent_count = sum(1 for msg in days_messages if msg.sender_id == current_user.id)
-        delivered_count = sum(1 for msg in days_messages if msg.status == 'DELIVERED')
+        counts = daily.get(date, empty)
         
         stats.append({
             'date': date.strftime('%a'),
-            'sent': sent_count,
-            'delivered': delivered_count
+            'sent': counts['sent'],
+            'delivered': counts['delivered']
         })
     
     # Reverse to show oldest to newest
     stats.reverse()
     
     # Calculate 30-day totals
-    thirty_days_ago = today - timedelta(days=30)
-    thirty_day_messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) | (Message.receiver_id == current_user.id)) &
-        (Message.timestamp >= thirty_days_ago)
-    ).all()
-    
     thirty_day_stats = {
-        'total_sent': sum(1 for msg in thirty_day_messages if msg.sender_id == current_user.id),
-        'total_delivered': sum(1 for msg in thirty_day_messages if msg.status == 'DELIVERED'),
-        'total_encrypted': sum(1 for msg in thirty_day_messages if msg.is_encrypted)
+        'total_sent': _sum_daily(daily, 'sent'),
+        'total_delivered': _sum_daily(daily, 'delivered'),
+        'total_encrypted': _sum_daily(daily, 'encrypted')
     }
     
     return {
         'weekly': stats,
         'monthly': thirty_day_stats
-    } 
\ No newline at end of file
+    }
@@ -1,8 +1,22 @@
+import math
+import threading
 from datetime import datetime
 from flask_login import UserMixin
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db, login_manager
 
+# INSERT constructs with ON CONFLICT clauses, per dialect that has them
+CONFLICT_INSERTS = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+def conflict_insert(model):
+    """INSERT ... ON CONFLICT for the session's database, or None if its dialect has no such clause"""
+    insert = CONFLICT_INSERTS.get(db.session.get_bind().dialect.name)
+    return insert(model) if insert else None
+
 @login_manager.user_loader
 def load_user(id):
     return User.query.get(int(id))
@@ -19,12 +33,60 @@ class User(UserMixin, db.Model):
     sent_messages = db.relationship('Message', foreign_keys='Message.sender_id', backref='sender', lazy='dynamic')
     received_messages = db.relationship('Message', foreign_keys='Message.receiver_id', backref='receiver', lazy='dynamic')
 
+    @property
+    def room(self):
+        """Socket.IO room joined by every connection of this user"""
+        return User.room_for(self.id)
+
+    @staticmethod
+    def room_for(user_id):
+        return f'user-{user_id}'
+
+    @staticmethod
+    def presence_room(phone_number):
+        """Socket.IO room of connections that want presence updates for a phone number"""
+        return f'presence-{phone_number}'
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @staticmethod
+    def ids_for_phones(phone_numbers):
+        """Map phone numbers to user ids (None if unregistered), querying only uncached numbers.
+
+        Only registered numbers are cached: peers choose the numbers they send,
+        so caching misses would let them grow the cache without bound.
+        """
+        with _user_ids_lock:
+            found = {phone: _user_ids[phone] for phone in phone_numbers if phone in _user_ids}
+        missing = set(phone_numbers) - found.keys()
+        if missing:
+            rows = dict(db.session.query(User.phone_number, User.id).filter(User.phone_number.in_(missing)))
+            with _user_ids_lock:
+                _user_ids.update(rows)
+            found.update({phone: rows.get(phone) for phone in missing})
+        return found
+
+# phone_number -> user id cache for the LAN receive path; holds registered users only
+_user_ids = {}
+_user_ids_lock = threading.Lock()
+
+@event.listens_for(User, 'after_insert')
+@event.listens_for(User, 'after_delete')
+def forget_user_id(mapper, connection, user):
+    """Registration and account deletion change which numbers resolve to users"""
+    with _user_ids_lock:
+        _user_ids.pop(user.phone_number, None)
+
+@event.listens_for(User.phone_number, 'set')
+def forget_changed_phone(user, value, old_value, initiator):
+    with _user_ids_lock:
+        _user_ids.pop(old_value, None)
+        _user_ids.pop(value, None)
+
 class Contact(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -33,22 +95,104 @@ class Contact(db.Model):
     
     __table_args__ = (db.UniqueConstraint('user_id', 'contact_phone', name='unique_contact'),)
 
+class Conversation(db.Model):
+    """A two-party thread, stored once per canonical (low, high) user pair"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_low_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user_high_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    # Denormalized so the contact sidebar never has to scan messages
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.id', use_alter=True, name='fk_conversation_last_message'))
+    last_activity = db.Column(db.DateTime, index=True)
+
+    last_message = db.relationship('Message', foreign_keys=[last_message_id], post_update=True)
+
+    __table_args__ = (db.UniqueConstraint('user_low_id', 'user_high_id', name='unique_conversation'),)
+
+    @staticmethod
+    def pair(user_a_id, user_b_id):
+        """Canonical ordering of two user ids"""
+        return min(user_a_id, user_b_id), max(user_a_id, user_b_id)
+
+    @classmethod
+    def involving(cls, user_id):
+        """Filter clause matching every conversation the user takes part in"""
+        return (cls.user_low_id == user_id) | (cls.user_high_id == user_id)
+
+    @classmethod
+    def find(cls, user_a_id, user_b_id):
+        low, high = cls.pair(user_a_id, user_b_id)
+        return cls.query.filter_by(user_low_id=low, user_high_id=high).first()
+
+    @classmethod
+    def between(cls, user_a_id, user_b_id):
+        """Get the conversation for two users, adding it to the session if new"""
+        conversation = cls.find(user_a_id, user_b_id)
+        if conversation is None:
+            low, high = cls.pair(user_a_id, user_b_id)
+            conversation = cls(user_low_id=low, user_high_id=high)
+            db.session.add(conversation)
+        return conversation
+
+    def peer_id(self, user_id):
+        return self.user_high_id if self.user_low_id == user_id else self.user_low_id
+
+    def record(self, message):
+        """Attach a new message and advance the denormalized activity fields"""
+        if message.timestamp is None:
+            message.timestamp = datetime.utcnow()
+        message.conversation = self
+        self.last_message = message
+        self.last_activity = message.timestamp
+
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id', name='fk_message_conversation'))
+    blob_sha256 = db.Column(db.String(64), db.ForeignKey('blob.sha256', name='fk_message_blob'), index=True)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     is_file = db.Column(db.Boolean, default=False)
     file_type = db.Column(db.String(50))
     file_name = db.Column(db.String(255))
     status = db.Column(db.String(20), default='DELIVERED')  # Message delivery status
+    # LAN outbox: set while the message still has to reach its peer
+    delivery_attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime)
     is_encrypted = db.Column(db.Boolean, default=True)  # Whether the message is encrypted
     # Encryption fields
-    encrypted_content = db.Column(db.Text)
+    encrypted_content = db.Column(db.LargeBinary)  # Binary envelope; older rows may hold JSON text
     message_number = db.Column(db.Integer)
     encryption_metadata = db.Column(db.Text)  # For storing nonce and other encryption data
 
+    conversation = db.relationship('Conversation', foreign_keys=[conversation_id], backref=db.backref('messages', lazy='dynamic'))
+
+    # Cover keyset pagination of a conversation ordered by (timestamp, id)
+    __table_args__ = (
+        db.Index('ix_message_conversation', 'conversation_id', 'timestamp', 'id'),
+        # Partial index: only messages still in the outbox
+        db.Index('ix_message_outbox', 'next_attempt_at', sqlite_where=db.text('next_attempt_at IS NOT NULL')),
+    )
+
+    # Delivery status names used by the chat page's message_status handler
+    STATUS_LABELS = {'PENDING': 'sending', 'DELIVERED': 'delivered', 'FAILED': 'failed'}
+
+    def set_status(self, status):
+        """Change the delivery status, keeping the daily rollup in step"""
+        if status != self.status:
+            MessageDailyStats.record_status_change(self, self.status, status)
+            self.status = status
+
+    @property
+    def status_label(self):
+        return Message.STATUS_LABELS.get(self.status, 'sent')
+
+    def queue_for_delivery(self):
+        """Put a new message in the LAN outbox; call before add_message"""
+        self.status = 'PENDING'
+        self.delivery_attempts = 0
+        self.next_attempt_at = datetime.utcnow()
+
     def encrypt_content(self, encryption_manager, recipient_id):
         """Encrypt the message content"""
         if not self.encrypted_content:
@@ -62,4 +206,170 @@ class Message(db.Model):
         if self.encrypted_content and not self.content:
             self.content = encryption_manager.decrypt_message(self.encrypted_content, sender_id)
             return self.content
-        return None 
\ No newline at end of file
+        return None
+
+    @staticmethod
+    def decrypt_contents(messages, encryption_manager):
+        """Plaintext of each encrypted message in a page, keyed by id, decrypted as one batch"""
+        encrypted = [msg for msg in messages if msg.encrypted_content and not msg.content]
+        plaintexts = encryption_manager.decrypt_many(
+            (msg.encrypted_content, msg.sender_id, msg.receiver_id) for msg in encrypted
+        )
+        return {msg.id: text for msg, text in zip(encrypted, plaintexts)} 
+
+class Blob(db.Model):
+    """Content-addressed attachment bytes, shared by every message that carries them"""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @classmethod
+    def adjust_refs(cls, connection, sha256, delta):
+        connection.execute(
+            db.update(cls).where(cls.sha256 == sha256).values(ref_count=cls.ref_count + delta)
+        )
+
+@event.listens_for(Message, 'after_delete')
+def release_blob(mapper, connection, message):
+    """Drop a deleted file message's reference; `flask gc-blobs` removes unreferenced blobs"""
+    if message.blob_sha256:
+        Blob.adjust_refs(connection, message.blob_sha256, -1)
+
+class Upload(db.Model):
+    """A resumable chunked file upload that has not been finalized yet"""
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    file_name = db.Column(db.String(255), nullable=False)
+    file_type = db.Column(db.String(50), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    chunk_size = db.Column(db.Integer, nullable=False)
+    received = db.Column(db.Text, nullable=False)  # One '0'/'1' flag per chunk
+    sha256 = db.Column(db.String(64))  # Expected digest, if the client supplied one
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+
+    receiver = db.relationship('User', foreign_keys=[receiver_id])
+
+    @property
+    def chunk_count(self):
+        return max(1, math.ceil(self.size / self.chunk_size))
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+    def has_chunk(self, index):
+        return self.received[index] == '1'
+
+    def mark_received(self, index):
+        """Flag one chunk in a single UPDATE so concurrent chunk PUTs don't overwrite each other's flags"""
+        Upload.query.filter_by(id=self.id).update({
+            Upload.received: db.func.substr(Upload.received, 1, index, type_=db.Text) + '1' +
+                             db.func.substr(Upload.received, index + 2, type_=db.Text)
+        }, synchronize_session=False)
+        db.session.expire(self, ['received'])
+
+    @property
+    def received_chunks(self):
+        return [i for i, flag in enumerate(self.received) if flag == '1']
+
+    @property
+    def complete(self):
+        return '0' not in self.received
+
+class MessageDailyStats(db.Model):
+    """Per-user, per-day message counters maintained alongside Message writes.
+
+    Every message counts once for its sender and once for its receiver, so a
+    user's dashboard only ever reads its own handful of rows.
+    """
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    sent = db.Column(db.Integer, nullable=False, default=0)
+    delivered = db.Column(db.Integer, nullable=False, default=0)
+    encrypted = db.Column(db.Integer, nullable=False, default=0)
+
+    COUNTERS = ('total', 'sent', 'delivered', 'encrypted')
+
+    @classmethod
+    def bump(cls, user_id, day, **deltas):
+        """Atomically add ``deltas`` to a user's counters for ``day``"""
+        values = {name: deltas.get(name, 0) for name in cls.COUNTERS}
+        stmt = conflict_insert(cls)
+        if stmt is not None:
+            stmt = stmt.values(user_id=user_id, day=day, **values)
+            db.session.execute(stmt.on_conflict_do_update(
+                index_elements=['user_id', 'day'],
+                set_={name: getattr(cls, name) + stmt.excluded[name] for name in cls.COUNTERS}
+            ))
+            return
+
+        # Other databases: update the row, or insert it if there is none yet
+        update = db.update(cls).where(cls.user_id == user_id, cls.day == day).values(
+            {name: getattr(cls, name) + value for name, value in values.items()}
+        )
+        if db.session.execute(update).rowcount:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(cls).values(user_id=user_id, day=day, **values))
+        except IntegrityError:
+            # Another writer inserted the row first
+            db.session.execute(update)
+
+    @classmethod
+    def record(cls, message):
+        """Count a new message; call in the same transaction that inserts it"""
+        # Resolve column defaults now, since they are otherwise applied at flush
+        if message.timestamp is None:
+            message.timestamp = datetime.utcnow()
+        if message.status is None:
+            message.status = Message.__table__.c.status.default.arg
+        if message.is_encrypted is None:
+            message.is_encrypted = Message.__table__.c.is_encrypted.default.arg
+
+        for user_id in {message.sender_id, message.receiver_id}:
+            cls.bump(
+                user_id, message.timestamp.date(),
+                total=1,
+                sent=int(user_id == message.sender_id),
+                delivered=int(message.status == 'DELIVERED'),
+                encrypted=int(bool(message.is_encrypted))
+            )
+
+    @classmethod
+    def record_status_change(cls, message, old_status, new_status):
+        delta = int(new_status == 'DELIVERED') - int(old_status == 'DELIVERED')
+        if delta and message.timestamp is not None:
+            for user_id in {message.sender_id, message.receiver_id}:
+                cls.bump(user_id, message.timestamp.date(), delivered=delta)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every counter from the message table"""
+        day = db.func.date(Message.timestamp)
+        delivered = db.case((Message.status == 'DELIVERED', 1), else_=0)
+        encrypted = db.case((Message.is_encrypted == True, 1), else_=0)
+        sides = db.union_all(
+            db.select(Message.sender_id.label('user_id'), day.label('day'),
+                      db.literal(1).label('sent'), delivered.label('delivered'),
+                      encrypted.label('encrypted')),
+            db.select(Message.receiver_id, day, db.literal(0), delivered, encrypted)
+            .where(Message.receiver_id != Message.sender_id)
+        ).subquery()
+        rollup = db.select(
+            sides.c.user_id, sides.c.day, db.func.count(), db.func.sum(sides.c.sent),
+            db.func.sum(sides.c.delivered), db.func.sum(sides.c.encrypted)
+        ).group_by(sides.c.user_id, sides.c.day)
+
+        db.session.execute(db.delete(cls))
+        db.session.execute(db.insert(cls).from_select(['user_id', 'day', *cls.COUNTERS], rollup))
+
+def add_message(message):
+    """Add a new message to the session along with its conversation and rollup updates"""
+    Conversation.between(message.sender_id, message.receiver_id).record(message)
+    MessageDailyStats.record(message)
+    if message.blob_sha256:
+        Blob.adjust_refs(db.session, message.blob_sha256, 1)
+    db.session.add(message)
@@ -1,26 +1,77 @@
 import socket
 import threading
-import json
 import time
-from queue import Queue
-from flask import current_app
-from app import socketio, db
-from app.models import User, Message
+import os
+import hashlib
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from queue import Queue, Empty
+from flask import current_app, has_app_context
+from werkzeug.utils import secure_filename
+from app import socketio, db, blobstore, thumbnails
+from app.models import User, Message, add_message
+from app import protocol
+from app.peer_pool import PeerConnectionPool, IDLE_TIMEOUT, ACK_TIMEOUT
+from app.outbox import outbox
+from app.peer_cache import PeerCache
+from app.encryption import get_encryption_manager, stream_ciphertext_size
 import socket
 import ipaddress
 from datetime import datetime
 from zeroconf import ServiceInfo, Zeroconf, ServiceBrowser
 
+# File transfers: bytes handed to one sendfile() call, receive buffer size, socket timeout
+FILE_SEND_SLICE = 4 * 1024 * 1024
+FILE_RECV_BUFFER = 256 * 1024
+FILE_TIMEOUT = 30
+# Minimum seconds between file_progress events for one transfer
+PROGRESS_INTERVAL = 0.25
+# Inbound connections silent for this long are closed; outlives the senders' idle eviction
+SERVER_IDLE_TIMEOUT = IDLE_TIMEOUT * 2
+# Most received messages persisted in one transaction
+RECEIVE_BATCH_SIZE = 64
+# (sender, message_id) pairs remembered to drop messages a peer sends twice
+SEEN_MESSAGE_IDS = 10000
+# Seconds a received item may wait for its commit before we ack it as an error; within the sender's ACK_TIMEOUT
+STORE_TIMEOUT = ACK_TIMEOUT - 1
+# Service resolution: worker threads, and milliseconds to wait for a peer to answer
+RESOLVE_WORKERS = 8
+RESOLVE_TIMEOUT = 3000
+# Seconds between checks for peers whose discovery TTL ran out
+PEER_SWEEP_INTERVAL = 15
+
 class NetworkManager:
-    def __init__(self, user_phone):
+    # Seconds to coalesce peer appear/disappear callbacks before pushing presence
+    presence_debounce = 0.5
+    # Port the messaging server listens on and advertises; 0 picks a free one
+    tcp_port = 12345
+
+    def __init__(self, user_phone, app=None):
         self.user_phone = user_phone  # This will be our unique ID
-        self.tcp_port = 12345
-        self.peers = {}  # Format: {phone_number: {'ip': ip}}
+        # Worker threads have no app context of their own, so keep hold of the app
+        if app is None and has_app_context():
+            app = current_app._get_current_object()
+        self.app = app
+        self.peer_cache = PeerCache()
+        # Services are resolved on these workers, never on zeroconf's own thread
+        self._resolver = ThreadPoolExecutor(max_workers=RESOLVE_WORKERS, thread_name_prefix='zeroconf-resolve')
+        self._resolving = set()
+        self._resolving_lock = threading.Lock()
         self.message_queue = Queue()
+        self._seen_messages = OrderedDict()
+        self._pending_messages = {}
+        self._seen_lock = threading.Lock()
+        self.pool = PeerConnectionPool()
         self.running = False
         
-        # Initialize Zeroconf
-        self.zeroconf = Zeroconf()
+        # Presence changes waiting to be pushed, and the last state pushed per peer
+        self._presence_lock = threading.Lock()
+        self._pending_presence = {}
+        self._announced_presence = {}
+        self._presence_timer = None
+        
+        # Zeroconf service identity; discovery itself starts in start()
         self.service_type = "_chatapp._tcp.local."
         self.service_name = f"{self.user_phone}.{self.service_type}"
         
@@ -40,32 +91,65 @@ class NetworkManager:
         self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.tcp_socket.bind(('', self.tcp_port))
         self.tcp_socket.listen(5)
+        self.tcp_port = self.tcp_socket.getsockname()[1]
+        
+        # Socket.IO room of the local user, for file transfer progress
+        self.user_room = None
+        if self.app:
+            with self.app.app_context():
+                user = User.query.filter_by(phone_number=self.user_phone).first()
+                self.user_room = user.room if user else None
+
+    @property
+    def peers(self):
+        """Snapshot of live peers: {phone_number: {'ip': ip, 'port': port}}"""
+        return self.peer_cache.snapshot()
 
     def start(self):
         self.running = True
-        
-        # Register our service
-        self._register_service()
-        
-        # Start service browser
-        self.browser = ServiceBrowser(self.zeroconf, self.service_type, self)
+        self._start_discovery()
         
         # Start TCP messaging threads
+        self.pool.start()
         threading.Thread(target=self._tcp_server, daemon=True).start()
         threading.Thread(target=self._process_message_queue, daemon=True).start()
 
     def stop(self):
         self.running = False
+        with self._presence_lock:
+            if self._presence_timer:
+                self._presence_timer.cancel()
+        self.pool.stop()
+        self.message_queue.put(None)  # Wake the consumer so it can exit
+        self._forget()
         try:
-            self.zeroconf.unregister_service(self.info)
-            self.zeroconf.close()
+            self._stop_discovery()
             self.tcp_socket.close()
         except:
             pass
 
-    def _register_service(self):
-        """Register our service with Zeroconf"""
-        self.info = ServiceInfo(
+    def _forget(self):
+        """Stop get_network_manager() from returning this manager once it is stopped"""
+        global network_manager
+        if network_manager is self:
+            network_manager = None
+
+    def _start_discovery(self):
+        """Register our service and browse for peers"""
+        self.zeroconf = Zeroconf()
+        self.info = self._service_info()
+        self.zeroconf.register_service(self.info)
+        self.browser = ServiceBrowser(self.zeroconf, self.service_type, self)
+        threading.Thread(target=self._sweep_peers, daemon=True).start()
+
+    def _stop_discovery(self):
+        self._resolver.shutdown(wait=False)
+        self.zeroconf.unregister_service(self.info)
+        self.zeroconf.close()
+
+    def _service_info(self):
+        """Zeroconf record advertising our phone number and messaging port"""
+        return ServiceInfo(
             self.service_type,
             self.service_name,
             addresses=[socket.inet_aton(self.local_ip)],
@@ -74,54 +158,225 @@ class NetworkManager:
                 'phone': self.user_phone.encode('utf-8')
             }
         )
-        self.zeroconf.register_service(self.info)
 
-    def send_message(self, receiver_phone, content, message_id):
-        """Send a message to a peer"""
+    def send_message(self, receiver_phone, content, message_id, envelope=None):
+        """Send a message to a peer, with its encrypted envelope as a raw DATA frame if it has one"""
         try:
             peer_info = self.peers.get(receiver_phone)
             if not peer_info:
                 return False
                 
-            message_data = {
-                'type': 'message',
-                'message_id': message_id,
-                'sender_phone': self.user_phone,
-                'content': content
-            }
-            
-            return self.send_tcp_message(peer_info['ip'], json.dumps(message_data))
+            message_data = self._chat_frame(content, message_id, envelope)
+            ack = self.pool.request(receiver_phone, self._peer_address(peer_info), message_data, envelope)
+            return ack.get('status') == 'ok'
         except Exception as e:
             print(f"Error sending message: {e}")
             return False
 
+    def _chat_frame(self, content, message_id, envelope=None):
+        frame = {
+            'type': 'message',
+            'message_id': message_id,
+            'sender_phone': self.user_phone,
+            'content': content
+        }
+        if envelope is not None:
+            frame['envelope'] = len(envelope)
+        return frame
+
+    def _file_frame(self, size, file_info, message_id):
+        return {
+            'type': 'file',
+            'message_id': message_id,
+            'sender_phone': self.user_phone,
+            'filename': file_info['filename'],
+            'file_type': file_info['file_type'],
+            'sha256': file_info['sha256'],
+            'size': size
+        }
+
+    def _peer_address(self, peer_info):
+        return (peer_info['ip'], peer_info.get('port', self.tcp_port))
+
+    def send_file(self, receiver_phone, path, file_info, message_id):
+        """Stream a stored attachment to a peer in the background"""
+        peer_info = self.peers.get(receiver_phone)
+        if not peer_info:
+            return False
+        
+        threading.Thread(
+            target=self._send_file,
+            args=(self._peer_address(peer_info), receiver_phone, path, file_info, message_id),
+            daemon=True
+        ).start()
+        return True
+
+    def _send_file(self, address, receiver_phone, path, file_info, message_id):
+        """Send a file header frame, then the body as one DATA frame written with zero-copy sendfile().
+
+        Files go over their own connection so a large body never queues chat
+        messages behind it on the pooled one. With an encryption session for
+        the peer the body is sealed chunk by chunk on the way out instead.
+        """
+        try:
+            size = os.path.getsize(path)
+            header = self._file_frame(size, file_info, message_id)
+            encryptor = self._file_encryptor(receiver_phone)
+            if encryptor:
+                header['encrypted'] = True
+            body_size = self._body_size(header)
+            progress = self._progress_reporter(message_id, receiver_phone, file_info['filename'], body_size, 'send')
+            
+            with socket.create_connection(address, timeout=FILE_TIMEOUT) as sock, \
+                    open(path, 'rb') as f:
+                sock.sendall(protocol.encode_json(header) + protocol.encode_header(protocol.FRAME_DATA, body_size))
+                sent = 0
+                if encryptor:
+                    for sealed in encryptor.chunks(f):
+                        sock.sendall(sealed)
+                        sent += len(sealed)
+                        progress(sent)
+                while sent < body_size:
+                    count = sock.sendfile(f, offset=sent, count=min(FILE_SEND_SLICE, size - sent))
+                    if not count:
+                        raise ConnectionError('Peer stopped accepting data')
+                    sent += count
+                    progress(sent)
+                
+                frame = protocol.read_frame(sock, protocol.FrameDecoder())
+                ack = protocol.decode_json(frame[1]) if frame and frame[0] == protocol.FRAME_JSON else {}
+                progress(sent, status='done' if ack.get('status') == 'ok' else 'failed')
+        except Exception as e:
+            print(f"Error sending file: {e}")
+            self._emit_progress(message_id, receiver_phone, file_info['filename'], 0, 0, 'failed', 'send')
+
+    def _progress_reporter(self, transfer_id, peer_phone, filename, size, direction):
+        """Callable reporting transfer progress, throttled to PROGRESS_INTERVAL"""
+        last = [0.0]
+        
+        def report(done, status='active'):
+            now = time.monotonic()
+            if status == 'active' and done < size and now - last[0] < PROGRESS_INTERVAL:
+                return
+            last[0] = now
+            self._emit_progress(transfer_id, peer_phone, filename, done, size, status, direction)
+        return report
+
+    def _emit_progress(self, transfer_id, peer_phone, filename, done, size, status, direction):
+        if not self.user_room:
+            return
+        try:
+            socketio.emit('file_progress', {
+                'transfer_id': f'{direction}-{transfer_id}',
+                'peer_phone': peer_phone,
+                'filename': filename,
+                'direction': direction,
+                'bytes': done,
+                'size': size,
+                'status': status
+            }, to=self.user_room)
+        except Exception as e:
+            print(f"Error reporting transfer progress: {e}")
+
     # Zeroconf callback methods
     def add_service(self, zc, type_, name):
-        """Called when a new service is discovered"""
-        info = zc.get_service_info(type_, name)
+        """Called when a new service is discovered; resolves it off the zeroconf thread"""
+        self._schedule_resolve(zc, type_, name)
+
+    def remove_service(self, zc, type_, name):
+        """Called when a service is removed"""
+        self._peer_lost(name)
+
+    def update_service(self, zc, type_, name):
+        """Called when a service is updated"""
+        self.add_service(zc, type_, name)
+
+    def _schedule_resolve(self, zc, type_, name, revalidate=False):
+        with self._resolving_lock:
+            if name in self._resolving:
+                return
+            self._resolving.add(name)
+        self._resolver.submit(self._resolve, zc, type_, name, revalidate)
+
+    def _resolve(self, zc, type_, name, revalidate):
+        """Look up a service's address; a peer being revalidated is dropped if it does not answer"""
+        try:
+            info = zc.get_service_info(type_, name, timeout=RESOLVE_TIMEOUT)
+            if info:
+                self._peer_discovered(info)
+            elif revalidate:
+                self._peer_lost(name)
+        except Exception as e:
+            print(f"Error resolving service: {e}")
+        finally:
+            with self._resolving_lock:
+                self._resolving.discard(name)
+
+    def _expired_peer_names(self):
+        return [f"{phone}.{self.service_type}" for phone in self.peer_cache.expired()]
+
+    def _sweep_peers(self):
+        """Re-resolve peers whose TTL ran out, in case their goodbye packet was missed"""
+        while self.running:
+            time.sleep(PEER_SWEEP_INTERVAL)
+            for name in self._expired_peer_names():
+                self._schedule_resolve(self.zeroconf, self.service_type, name, revalidate=True)
+
+    def _peer_discovered(self, info):
+        """Record a resolved peer service"""
         if info and info.properties:
             try:
                 peer_phone = info.properties[b'phone'].decode('utf-8')
                 if peer_phone != self.user_phone:
                     peer_ip = str(ipaddress.IPv4Address(info.addresses[0]))
-                    self.peers[peer_phone] = {
-                        'ip': peer_ip
-                    }
+                    if not self.peer_cache.update(peer_phone, peer_ip, info.port, getattr(info, 'host_ttl', None)):
+                        return  # Same address as before; the sighting just refreshed its TTL
+                    # A peer that moved must not be reached over its old pooled socket
+                    self.pool.update_address(peer_phone, (peer_ip, info.port))
+                    self._queue_presence(peer_phone, True)
+                    # Flush whatever queued up while the peer was away
+                    outbox.peer_online(peer_phone)
             except Exception as e:
                 print(f"Error adding service: {e}")
 
-    def remove_service(self, zc, type_, name):
-        """Called when a service is removed"""
+    def _peer_lost(self, name):
+        """Forget the peer behind a service that went away"""
         try:
             peer_phone = name.replace(f".{self.service_type}", "")
-            if peer_phone in self.peers:
-                del self.peers[peer_phone]
+            if self.peer_cache.remove(peer_phone):
+                self.pool.discard(peer_phone)
+                self._queue_presence(peer_phone, False)
         except Exception as e:
             print(f"Error removing service: {e}")
 
-    def update_service(self, zc, type_, name):
-        """Called when a service is updated"""
-        self.add_service(zc, type_, name)
+    def _queue_presence(self, peer_phone, online):
+        """Record a presence change and schedule a debounced push"""
+        with self._presence_lock:
+            self._pending_presence[peer_phone] = online
+            if self._presence_timer is None:
+                self._presence_timer = threading.Timer(self.presence_debounce, self._flush_presence)
+                self._presence_timer.daemon = True
+                self._presence_timer.start()
+
+    def _flush_presence(self):
+        """Push the coalesced presence changes to the rooms watching each peer"""
+        with self._presence_lock:
+            pending = self._pending_presence
+            self._pending_presence = {}
+            self._presence_timer = None
+        
+        for peer_phone, online in pending.items():
+            # Skip peers that flapped back to the state browsers already know
+            if self._announced_presence.get(peer_phone, False) == online:
+                continue
+            self._announced_presence[peer_phone] = online
+            try:
+                socketio.emit('presence', {
+                    'phone': peer_phone,
+                    'online': online
+                }, to=User.presence_room(peer_phone))
+            except Exception as e:
+                print(f"Error pushing presence: {e}")
 
     def _tcp_server(self):
         """Handle incoming TCP connections"""
@@ -137,62 +392,345 @@ class NetworkManager:
                 if self.running:
                     time.sleep(1)
 
+    def _app_context(self):
+        return self.app.app_context()
+
     def _process_message_queue(self):
-        """Process received messages"""
+        """Persist received messages in batches, one transaction per batch"""
         while self.running:
+            item = self.message_queue.get()
+            if item is None:
+                break
+            batch = [item]
+            # Take whatever else has already arrived, without waiting for more
+            while len(batch) < RECEIVE_BATCH_SIZE:
+                try:
+                    item = self.message_queue.get_nowait()
+                except Empty:
+                    break
+                if item is None:
+                    self.running = False
+                    break
+                batch.append(item)
             try:
-                message = self.message_queue.get()
-                if message.get('type') == 'chat':
-                    # Save and emit message
-                    with current_app.app_context():
-                        sender = User.query.filter_by(phone_number=message['sender']).first()
-                        receiver = User.query.filter_by(phone_number=message['receiver']).first()
-                        
-                        if sender and receiver:
-                            # Create new message
-                            new_message = Message(
-                                sender_id=sender.id,
-                                receiver_id=receiver.id,
-                                content=message['content']
-                            )
-                            db.session.add(new_message)
-                            db.session.commit()
-                            
-                            # Emit new message event
-                            socketio.emit('new_message', {
-                                'message': {
-                                    'id': new_message.id,
-                                    'content': new_message.content,
-                                    'timestamp': new_message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-                                    'sender_phone': message['sender'],
-                                    'receiver_phone': message['receiver']
-                                }
-                            })
+                self._store_batch(batch)
             except Exception as e:
                 print(f"Error processing message: {e}")
+            finally:
+                self._finish(batch, ())
+        # Anything still queued at shutdown is never stored; let its sender retry
+        while True:
+            try:
+                item = self.message_queue.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                self._finish([item], ())
+
+    def _finish(self, batch, stored):
+        """Resolve each item's future: True if it was committed, False if it was dropped or failed"""
+        kept = {id(item) for item, _ in stored}
+        for item in batch:
+            future = item.get('stored')
+            if future and not future.done():
+                if item.get('key'):
+                    self._settle_delivery(item['key'], id(item) in kept)
+                future.set_result(id(item) in kept)
+
+    def _store_batch(self, batch):
+        """Insert a batch of received chat messages and files, then announce them"""
+        with self._app_context():
+            user_ids = User.ids_for_phones({phone for item in batch for phone in (item['sender'], item['receiver'])})
+            stored = []
+            try:
+                for item in batch:
+                    message = self._add_received(item, user_ids)
+                    if message:
+                        stored.append((item, message))
+                db.session.flush()
+                ids = [message.id for _, message in stored]
+                db.session.commit()
+            except Exception as e:
+                # Retry one at a time so only the rows that fail are acked as errors
+                db.session.rollback()
+                print(f"Error storing received batch, retrying item by item: {e}")
+                stored = self._store_items(batch, user_ids)
+                ids = [message.id for _, message in stored]
+            # Committed: the handlers waiting on these items can ack them now
+            self._finish(batch, stored)
+            
+            # Reload the expired batch in one round trip rather than one per message
+            Message.query.filter(Message.id.in_(ids)).all()
+            
+            for item, message in stored:
+                if item['type'] == 'file' and item['file_type'] == 'image':
+                    thumbnails.schedule(blobstore.blob_path(item['sha256']), self.app.config['THUMBNAIL_SIZES'])
+                
+                payload = {
+                    'id': message.id,
+                    'content': message.content,
+                    'timestamp': message.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+                    'sender_phone': item['sender'],
+                    'receiver_phone': item['receiver']
+                }
+                if item['type'] == 'file':
+                    payload.update(is_file=True, file_type=item['file_type'], file_name=item['filename'])
+                socketio.emit('new_message', {'message': payload},
+                              to=[User.room_for(message.sender_id), User.room_for(message.receiver_id)])
+
+    def _add_received(self, item, user_ids):
+        """Add one received item to the session; returns its Message, or None if it was dropped"""
+        sender_id, receiver_id = user_ids[item['sender']], user_ids[item['receiver']]
+        if not (sender_id and receiver_id):
+            if item['type'] == 'file' and os.path.exists(item['path']):
+                os.remove(item['path'])
+            return None
+        
+        if item['type'] == 'file':
+            blobstore.put_file(item['path'], item['sha256'], item['size'])
+            message = Message(
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                content=blobstore.blob_name(item['sha256'], item['filename']),
+                is_file=True,
+                file_type=item['file_type'],
+                file_name=item['filename'],
+                blob_sha256=item['sha256']
+            )
+        else:
+            message = Message(
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                content=item['content'],
+                encrypted_content=item['envelope']
+            )
+        add_message(message)
+        return message
+
+    def _store_items(self, batch, user_ids):
+        """Store a failed batch with a savepoint per item; returns the (item, message) pairs kept"""
+        stored = []
+        for item in batch:
+            try:
+                if item['type'] == 'file' and user_ids[item['sender']] and user_ids[item['receiver']]:
+                    # Outside the savepoint: if the message fails, the blob still gets a row for gc-blobs
+                    blobstore.put_file(item['path'], item['sha256'], item['size'])
+                with db.session.begin_nested():
+                    message = self._add_received(item, user_ids)
+                    db.session.flush()
+            except Exception as e:
+                print(f"Error storing message from {item['sender']}: {e}")
+                continue
+            if message:
+                stored.append((item, message))
+        db.session.commit()
+        return stored
+
+    def _check_file_header(self, header):
+        """Validated (filename, file_type, size) of an incoming file, or None to refuse it"""
+        size = int(header['size'])
+        filename = secure_filename(header['filename'])
+        file_type = header['file_type']
+        config = self.app.config
+        if size < 0 or size > config['MAX_UPLOAD_SIZE'] or not filename or file_type not in ('image', 'file'):
+            return None
+        return filename, file_type, size
+
+    def _body_size(self, header):
+        """Length of a file's DATA frame: the file itself, or its sealed stream"""
+        size = int(header['size'])
+        return stream_ciphertext_size(size) if header.get('encrypted') else size
+
+    def _peer_session_id(self, peer_phone):
+        """User id of a peer we hold an encryption session with, or None"""
+        encryption_mgr = get_encryption_manager()
+        if not encryption_mgr:
+            return None
+        with self._app_context():
+            peer_id = User.ids_for_phones({peer_phone})[peer_phone]
+        return peer_id if peer_id and encryption_mgr.has_session(peer_id) else None
+
+    def _file_encryptor(self, peer_phone):
+        """StreamEncryptor for a file to a peer, or None to send it as is"""
+        peer_id = self._peer_session_id(peer_phone)
+        return get_encryption_manager().file_encryptor(peer_id) if peer_id else None
+
+    def _file_decryptor(self, header):
+        """StreamDecryptor for an encrypted incoming file, or None if we hold no session to open it"""
+        peer_id = self._peer_session_id(header['sender_phone'])
+        return get_encryption_manager().file_decryptor(peer_id) if peer_id else None
+
+    def _staging_file(self):
+        """Open a temporary file in the blob store's staging area; returns (fd, path)"""
+        with self._app_context():
+            staging = blobstore.staging_dir()
+        return tempfile.mkstemp(dir=staging, suffix='.part')
+
+    def _queue_received(self, item):
+        """Queue a received item for the consumer; returns a future that resolves to whether it was stored"""
+        item['stored'] = Future()
+        self.message_queue.put(item)
+        return item['stored']
+
+    def _wait_stored(self, stored):
+        """Block until a queued item is committed; False if storing it failed or took too long"""
+        try:
+            return stored.result(timeout=STORE_TIMEOUT)
+        except FutureTimeout:
+            return False
+
+    def _file_received(self, header, filename, file_type, path):
+        """Queue a verified incoming file for storage; returns the future _queue_received does"""
+        return self._queue_received({
+            'type': 'file',
+            'sender': header['sender_phone'],
+            'receiver': self.user_phone,
+            'filename': filename,
+            'file_type': file_type,
+            'sha256': header['sha256'],
+            'size': int(header['size']),
+            'path': path
+        })
+
+    def _check_envelope(self, message, frame):
+        """The encrypted envelope a chat header announced, from the DATA frame after it"""
+        if frame is None or frame[0] != protocol.FRAME_DATA or len(frame[1]) != message['envelope']:
+            raise protocol.ProtocolError('Expected the envelope as a DATA frame of the declared size')
+        return frame[1]
+
+    def _settle_delivery(self, key, ok):
+        """Remember a (sender, message_id) pair once its message is committed; a failed one may be resent"""
+        with self._seen_lock:
+            self._pending_messages.pop(key, None)
+            if ok:
+                self._seen_messages[key] = True
+                if len(self._seen_messages) > SEEN_MESSAGE_IDS:
+                    self._seen_messages.popitem(last=False)
+
+    def _chat_received(self, message, envelope=None):
+        """Queue an incoming chat message; returns a future that resolves to whether it was stored.
+
+        A message_id already committed, e.g. resent after a lost ack, is not
+        stored again; one still waiting for its commit shares that future.
+        """
+        key = None
+        if message.get('message_id') is not None:
+            key = (message['sender_phone'], message['message_id'])
+        with self._seen_lock:
+            if key in self._seen_messages:
+                stored = Future()
+                stored.set_result(True)
+                return stored
+            if key in self._pending_messages:
+                return self._pending_messages[key]
+            stored = self._queue_received({
+                'type': 'chat',
+                'sender': message['sender_phone'],
+                'receiver': self.user_phone,
+                'content': message['content'],
+                'envelope': envelope,
+                'key': key
+            })
+            if key:
+                self._pending_messages[key] = stored
+        return stored
+
+    def _ack(self, message, ok):
+        return {
+            'type': 'ack',
+            'message_id': message.get('message_id'),
+            'status': 'ok' if ok else 'error'
+        }
+
+    def _receive_file(self, client_socket, decoder, header):
+        """Stream an incoming file's DATA frame to disk, verifying its size and SHA-256"""
+        accepted = self._check_file_header(header)
+        if not accepted:
+            return False
+        filename, file_type, size = accepted
+        decryptor = self._file_decryptor(header) if header.get('encrypted') else None
+        if header.get('encrypted') and not decryptor:
+            return False
+        body_size = self._body_size(header)
+        
+        frame_type, length = protocol.read_header(client_socket, decoder)
+        if frame_type != protocol.FRAME_DATA or length != body_size:
+            raise protocol.ProtocolError('Expected the file body as a DATA frame of the declared size')
+        
+        fd, path = self._staging_file()
+        sha256 = hashlib.sha256()
+        progress = self._progress_reporter(header.get('message_id'), header['sender_phone'], filename, body_size, 'receive')
+        client_socket.settimeout(FILE_TIMEOUT)
+        
+        def store(data):
+            if decryptor:
+                data = decryptor.update(data)
+            f.write(data)
+            sha256.update(data)
+        
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # Part of the body may already have arrived with the header
+                leftover = decoder.take(body_size)
+                store(leftover)
+                received = len(leftover)
+                
+                # Reuse one buffer for every read instead of allocating per chunk
+                buffer = memoryview(bytearray(FILE_RECV_BUFFER))
+                while received < body_size:
+                    count = client_socket.recv_into(buffer, min(FILE_RECV_BUFFER, body_size - received))
+                    if not count:
+                        raise ConnectionError('Peer closed the connection mid-transfer')
+                    store(buffer[:count])
+                    received += count
+                    progress(received)
+                if decryptor:
+                    last = decryptor.finalize()
+                    f.write(last)
+                    sha256.update(last)
+        except Exception:
+            os.remove(path)
+            progress(0, status='failed')
+            raise
+        
+        if sha256.hexdigest() != header['sha256']:
+            os.remove(path)
+            progress(received, status='failed')
+            return False
+        
+        ok = self._wait_stored(self._file_received(header, filename, file_type, path))
+        progress(received, status='done' if ok else 'failed')
+        return ok
 
     def _handle_client(self, client_socket, addr):
-        """Handle incoming TCP messages"""
+        """Handle the frames a peer sends on one connection until it closes"""
+        decoder = protocol.FrameDecoder()
         try:
-            data = client_socket.recv(4096)
-            if data:
-                message = json.loads(data.decode())
+            while self.running:
+                client_socket.settimeout(SERVER_IDLE_TIMEOUT)
+                frame = protocol.read_frame(client_socket, decoder)
+                if frame is None:
+                    break
+                frame_type, payload = frame
+                if frame_type != protocol.FRAME_JSON:
+                    raise protocol.ProtocolError('DATA frame without a file header')
+                message = protocol.decode_json(payload)
+                
+                if message.get('type') == 'file':
+                    ok = self._receive_file(client_socket, decoder, message)
+                    client_socket.sendall(protocol.encode_json(self._ack(message, ok)))
+                    if not ok:
+                        # A rejected body may still be in flight; drop the connection
+                        break
                 
-                if message.get('type') == 'message':
-                    # Process the message
-                    self.message_queue.put({
-                        'type': 'chat',
-                        'sender': message['sender_phone'],
-                        'receiver': self.user_phone,
-                        'content': message['content']
-                    })
-                    
-                    # Send acknowledgment
-                    ack = {
-                        'type': 'ack',
-                        'message_id': message.get('message_id')
-                    }
-                    client_socket.send(json.dumps(ack).encode())
+                elif message.get('type') == 'message':
+                    envelope = None
+                    if 'envelope' in message:
+                        envelope = self._check_envelope(message, protocol.read_frame(client_socket, decoder))
+                    ok = self._wait_stored(self._chat_received(message, envelope))
+                    client_socket.sendall(protocol.encode_json(self._ack(message, ok)))
+        except socket.timeout:
+            pass  # Idle peer; it reconnects on its next message
         except Exception as e:
             print(f"Error handling client message: {e}")
         finally:
@@ -204,13 +742,21 @@ class NetworkManager:
 # Global network manager instance
 network_manager = None
 
-def init_network(user_phone):
-    """Initialize the network manager for a user"""
+def init_network(user_phone, app=None):
+    """Initialize the network manager for a user, using the engine NETWORK_ENGINE selects"""
     global network_manager
     if network_manager:
         network_manager.stop()
-    network_manager = NetworkManager(user_phone)
+    manager_class = NetworkManager
+    if app and app.config['NETWORK_ENGINE'] == 'asyncio':
+        from app.network_async import AsyncNetworkManager
+        manager_class = AsyncNetworkManager
+    network_manager = manager_class(user_phone, app)
     network_manager.start()
+    if outbox.running:
+        outbox.notify()
+    else:
+        outbox.start()
 
 def get_network_manager():
     """Get the current network manager instance"""
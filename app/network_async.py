@@ -0,0 +1,299 @@
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from itertools import islice
+from zeroconf import ServiceStateChange
+from zeroconf.asyncio import AsyncZeroconf, AsyncServiceBrowser, AsyncServiceInfo
+from app import protocol
+from app.network import (NetworkManager, FILE_TIMEOUT, FILE_SEND_SLICE, FILE_RECV_BUFFER,
+                         SERVER_IDLE_TIMEOUT, RESOLVE_TIMEOUT, PEER_SWEEP_INTERVAL, STORE_TIMEOUT)
+from app.peer_pool import AsyncPeerConnectionPool, CONNECT_TIMEOUT, ACK_TIMEOUT
+
+# Sealed chunks produced per trip to a worker thread when sending an encrypted file
+SEAL_BATCH = 16
+
+class AsyncNetworkManager(NetworkManager):
+    """NetworkManager whose transport and discovery run on one asyncio event loop.
+
+    Inbound connections, outbound pooled connections, file transfers and
+    zeroconf all share a single loop thread instead of a thread per
+    connection. The public interface (start/stop/send_message/send_file/peers)
+    is unchanged and safe to call from any thread. Received messages still go
+    through ``message_queue`` to the database consumer thread.
+    """
+    def __init__(self, user_phone, app=None):
+        super().__init__(user_phone, app)
+        self.pool = AsyncPeerConnectionPool()
+        self.loop = None
+        self._loop_thread = None
+        self._server = None
+        # Last activity time of each inbound connection, keyed by its writer
+        self._inbound = {}
+
+    def start(self):
+        self.running = True
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_async(), self.loop).result()
+        threading.Thread(target=self._process_message_queue, daemon=True).start()
+
+    async def _start_async(self):
+        self._server = await asyncio.start_server(self._handle_stream, sock=self.tcp_socket)
+        self._sweeper = self.loop.create_task(self._close_idle_inbound())
+        self.pool.start()
+        await self._start_discovery_async()
+
+    def stop(self):
+        self.running = False
+        with self._presence_lock:
+            if self._presence_timer:
+                self._presence_timer.cancel()
+        self.message_queue.put(None)  # Wake the consumer so it can exit
+        self._forget()
+        if not self.loop:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._stop_async(), self.loop).result(timeout=10)
+        except Exception as e:
+            print(f"Error stopping network: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join()
+        self.loop.close()
+
+    async def _stop_async(self):
+        self.pool.stop()
+        self._sweeper.cancel()
+        self._server.close()
+        for writer in list(self._inbound):
+            writer.close()
+        await self._stop_discovery_async()
+
+    async def _start_discovery_async(self):
+        self.aiozc = AsyncZeroconf()
+        self.info = self._service_info()
+        await self.aiozc.async_register_service(self.info)
+        self.browser = AsyncServiceBrowser(
+            self.aiozc.zeroconf, self.service_type, handlers=[self._on_service_state_change]
+        )
+        self._peer_sweeper = self.loop.create_task(self._sweep_peers_async())
+
+    async def _stop_discovery_async(self):
+        self._peer_sweeper.cancel()
+        await self.browser.async_cancel()
+        await self.aiozc.async_unregister_all_services()
+        await self.aiozc.async_close()
+
+    def _on_service_state_change(self, zeroconf, service_type, name, state_change):
+        """Browser callback, on the loop thread; resolution happens in a task"""
+        if state_change is ServiceStateChange.Removed:
+            self._peer_lost(name)
+        else:
+            self.loop.create_task(self._resolve(service_type, name))
+
+    async def _resolve(self, service_type, name, revalidate=False):
+        info = AsyncServiceInfo(service_type, name)
+        if await info.async_request(self.aiozc.zeroconf, RESOLVE_TIMEOUT):
+            self._peer_discovered(info)
+        elif revalidate:
+            self._peer_lost(name)
+
+    async def _sweep_peers_async(self):
+        """Re-resolve peers whose TTL ran out, in case their goodbye packet was missed"""
+        while True:
+            await asyncio.sleep(PEER_SWEEP_INTERVAL)
+            for name in self._expired_peer_names():
+                self.loop.create_task(self._resolve(self.service_type, name, revalidate=True))
+
+    def send_message(self, receiver_phone, content, message_id, envelope=None):
+        """Send a message to a peer, blocking the calling thread until it is acked"""
+        peer_info = self.peers.get(receiver_phone)
+        if not peer_info or not self.running:
+            return False
+        future = asyncio.run_coroutine_threadsafe(
+            self._send_message(receiver_phone, self._peer_address(peer_info), content, message_id, envelope),
+            self.loop
+        )
+        try:
+            return future.result(timeout=2 * (CONNECT_TIMEOUT + ACK_TIMEOUT))
+        except Exception as e:
+            print(f"Error sending message: {e}")
+            return False
+
+    async def _send_message(self, receiver_phone, address, content, message_id, envelope=None):
+        ack = await self.pool.request(
+            receiver_phone, address, self._chat_frame(content, message_id, envelope), envelope
+        )
+        return ack.get('status') == 'ok'
+
+    def send_file(self, receiver_phone, path, file_info, message_id):
+        """Stream a stored attachment to a peer from the event loop"""
+        peer_info = self.peers.get(receiver_phone)
+        if not peer_info or not self.running:
+            return False
+        asyncio.run_coroutine_threadsafe(
+            self._send_file_async(self._peer_address(peer_info), receiver_phone, path, file_info, message_id),
+            self.loop
+        )
+        return True
+
+    async def _send_file_async(self, address, receiver_phone, path, file_info, message_id):
+        """Header frame, then the body as one DATA frame through the loop's sendfile().
+
+        The session lookup and the sealing of an encrypted body run on worker
+        threads, so other peers' connections keep being served meanwhile.
+        """
+        writer = None
+        try:
+            size = os.path.getsize(path)
+            header = self._file_frame(size, file_info, message_id)
+            encryptor = await asyncio.to_thread(self._file_encryptor, receiver_phone)
+            if encryptor:
+                header['encrypted'] = True
+            body_size = self._body_size(header)
+            progress = self._progress_reporter(message_id, receiver_phone, file_info['filename'], body_size, 'send')
+
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), CONNECT_TIMEOUT)
+            writer.write(protocol.encode_json(header) + protocol.encode_header(protocol.FRAME_DATA, body_size))
+            with open(path, 'rb') as f:
+                sent = 0
+                if encryptor:
+                    chunks = encryptor.chunks(f)
+                    while batch := await asyncio.to_thread(lambda: list(islice(chunks, SEAL_BATCH))):
+                        for sealed in batch:
+                            writer.write(sealed)
+                            sent += len(sealed)
+                        await asyncio.wait_for(writer.drain(), FILE_TIMEOUT)
+                        progress(sent)
+                while sent < body_size:
+                    count = await asyncio.wait_for(
+                        self.loop.sendfile(writer.transport, f, sent, min(FILE_SEND_SLICE, size - sent)),
+                        FILE_TIMEOUT
+                    )
+                    if not count:
+                        raise ConnectionError('Peer stopped accepting data')
+                    sent += count
+                    progress(sent)
+
+            frame = await asyncio.wait_for(protocol.read_frame_async(reader), FILE_TIMEOUT)
+            ack = protocol.decode_json(frame[1]) if frame and frame[0] == protocol.FRAME_JSON else {}
+            progress(sent, status='done' if ack.get('status') == 'ok' else 'failed')
+        except Exception as e:
+            print(f"Error sending file: {e}")
+            self._emit_progress(message_id, receiver_phone, file_info['filename'], 0, 0, 'failed', 'send')
+        finally:
+            if writer:
+                writer.close()
+
+    async def _close_idle_inbound(self):
+        """Close inbound connections silent for SERVER_IDLE_TIMEOUT.
+
+        One sweep replaces a timeout around every read, which would cost a
+        timer per frame.
+        """
+        while True:
+            await asyncio.sleep(SERVER_IDLE_TIMEOUT / 2)
+            cutoff = time.monotonic() - SERVER_IDLE_TIMEOUT
+            for writer, last_active in list(self._inbound.items()):
+                if last_active < cutoff:
+                    writer.close()
+
+    async def _handle_stream(self, reader, writer):
+        """Handle the frames a peer sends on one connection until it closes"""
+        self._inbound[writer] = time.monotonic()
+        try:
+            while self.running:
+                frame = await protocol.read_frame_async(reader)
+                if frame is None:
+                    break
+                self._inbound[writer] = time.monotonic()
+                frame_type, payload = frame
+                if frame_type != protocol.FRAME_JSON:
+                    raise protocol.ProtocolError('DATA frame without a file header')
+                message = protocol.decode_json(payload)
+
+                if message.get('type') == 'file':
+                    ok = await self._receive_file_async(reader, message)
+                    writer.write(protocol.encode_json(self._ack(message, ok)))
+                    await writer.drain()
+                    if not ok:
+                        # A rejected body may still be in flight; drop the connection
+                        break
+
+                elif message.get('type') == 'message':
+                    envelope = None
+                    if 'envelope' in message:
+                        envelope = self._check_envelope(message, await protocol.read_frame_async(reader))
+                    ok = await self._wait_stored_async(self._chat_received(message, envelope))
+                    writer.write(protocol.encode_json(self._ack(message, ok)))
+                    await writer.drain()
+        except Exception as e:
+            print(f"Error handling client message: {e}")
+        finally:
+            self._inbound.pop(writer, None)
+            writer.close()
+
+    async def _receive_file_async(self, reader, header):
+        """Stream an incoming file's DATA frame to disk, verifying its size and SHA-256.
+
+        Reads stay on the loop; the session lookup and each block's decryption,
+        hashing and write run on worker threads.
+        """
+        accepted = self._check_file_header(header)
+        if not accepted:
+            return False
+        filename, file_type, size = accepted
+        decryptor = await asyncio.to_thread(self._file_decryptor, header) if header.get('encrypted') else None
+        if header.get('encrypted') and not decryptor:
+            return False
+        body_size = self._body_size(header)
+
+        frame_type, length = await protocol.read_header_async(reader) or (None, None)
+        if frame_type != protocol.FRAME_DATA or length != body_size:
+            raise protocol.ProtocolError('Expected the file body as a DATA frame of the declared size')
+
+        fd, path = await asyncio.to_thread(self._staging_file)
+        sha256 = hashlib.sha256()
+        progress = self._progress_reporter(header.get('message_id'), header['sender_phone'], filename, body_size, 'receive')
+        received = 0
+
+        def store(block, last=False):
+            if decryptor:
+                block = decryptor.finalize() if last else decryptor.update(block)
+            f.write(block)
+            sha256.update(block)
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                while received < body_size:
+                    block = await asyncio.wait_for(reader.read(min(FILE_RECV_BUFFER, body_size - received)), FILE_TIMEOUT)
+                    if not block:
+                        raise ConnectionError('Peer closed the connection mid-transfer')
+                    received += len(block)
+                    await asyncio.to_thread(store, block)
+                    progress(received)
+                if decryptor:
+                    await asyncio.to_thread(store, b'', last=True)
+        except Exception:
+            os.remove(path)
+            progress(0, status='failed')
+            raise
+
+        if sha256.hexdigest() != header['sha256']:
+            os.remove(path)
+            progress(received, status='failed')
+            return False
+
+        ok = await self._wait_stored_async(self._file_received(header, filename, file_type, path))
+        progress(received, status='done' if ok else 'failed')
+        return ok
+
+    async def _wait_stored_async(self, stored):
+        """_wait_stored without blocking the loop"""
+        try:
+            # Shielded so a timeout leaves the future for the consumer to resolve
+            return await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(stored)), STORE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
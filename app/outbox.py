@@ -0,0 +1,152 @@
+import atexit
+import random
+import threading
+from datetime import datetime, timedelta
+from app import db, socketio
+from app.models import User, Message
+
+# Most outbox messages sent in one pass
+BATCH_SIZE = 100
+
+class Outbox:
+    """Retries LAN delivery of PENDING messages until their peer acks them.
+
+    The outbox lives in the database: a message is in it while its
+    ``next_attempt_at`` is set, so queued messages survive restarts. Failed
+    attempts back off exponentially with jitter. When discovery sees a peer
+    come back, everything queued for it is sent in one burst regardless of
+    its schedule. Only the logged-in user's messages are sent, through
+    that user's network manager.
+    """
+    def __init__(self, app=None):
+        self.app = None
+        self.running = False
+        self._wakeup = threading.Event()
+        self._online_lock = threading.Lock()
+        self._online = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.retry_base = app.config['OUTBOX_RETRY_BASE']
+        self.retry_max = app.config['OUTBOX_RETRY_MAX']
+        self.fail_after = app.config['OUTBOX_FAIL_AFTER']
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self._wakeup.set()
+            self._thread.join()
+
+    def notify(self):
+        """New messages were queued"""
+        self._wakeup.set()
+
+    def peer_online(self, phone_number):
+        """Discovery found a peer: flush its queued messages now"""
+        with self._online_lock:
+            self._online.add(phone_number)
+        self._wakeup.set()
+
+    def retry_delay(self, attempts):
+        """Backoff before the next attempt: exponential, capped, with equal jitter"""
+        delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    def _run(self):
+        from app.network import get_network_manager  # network imports this module
+        while self.running:
+            self._wakeup.clear()
+            timeout = None
+            try:
+                # Without a manager nothing can be sent; init_network wakes us with a new one
+                manager = get_network_manager()
+                with self.app.app_context():
+                    sender_id = manager and User.ids_for_phones({manager.user_phone})[manager.user_phone]
+                    if sender_id:
+                        self._flush_online_peers(manager, sender_id)
+                        self._send_due(manager, sender_id)
+                        timeout = self._seconds_until_next(sender_id)
+                    db.session.remove()
+            except Exception as e:
+                print(f"Error delivering outbox: {e}")
+                timeout = self.retry_base
+            self._wakeup.wait(timeout)
+
+    def _flush_online_peers(self, manager, sender_id):
+        with self._online_lock:
+            phones, self._online = self._online, set()
+        if not phones:
+            return
+        receiver_ids = [user_id for user_id in User.ids_for_phones(phones).values() if user_id]
+        queued = Message.query.filter(
+            Message.next_attempt_at.isnot(None),
+            Message.sender_id == sender_id,
+            Message.receiver_id.in_(receiver_ids)
+        ).order_by(Message.id).all()
+        self._deliver(manager, queued)
+
+    def _send_due(self, manager, sender_id):
+        while self.running and manager.running:
+            due = Message.query.filter(
+                Message.next_attempt_at <= datetime.utcnow(),
+                Message.sender_id == sender_id
+            ).order_by(Message.next_attempt_at).limit(BATCH_SIZE).all()
+            if not due:
+                return
+            self._deliver(manager, due)
+
+    def _seconds_until_next(self, sender_id):
+        next_attempt = db.session.query(db.func.min(Message.next_attempt_at)).filter(
+            Message.sender_id == sender_id
+        ).scalar()
+        if next_attempt is None:
+            return None
+        return max(0.0, (next_attempt - datetime.utcnow()).total_seconds())
+
+    def _deliver(self, manager, messages):
+        """Send messages peer by peer, in order; a peer's first failure fails the rest of its batch"""
+        phones = dict(db.session.query(User.id, User.phone_number).filter(
+            User.id.in_({message.receiver_id for message in messages})
+        ))
+        unreachable = set()
+        changed = []
+        for message in messages:
+            if not manager.running:
+                break  # Logged out mid-pass; the rest stay queued for the next manager
+            receiver_phone = phones.get(message.receiver_id)
+            delivered = (
+                receiver_phone not in unreachable
+                and manager.send_message(receiver_phone, message.content, message.id, message.encrypted_content)
+            )
+            old_status = message.status
+            if delivered:
+                message.set_status('DELIVERED')
+                message.next_attempt_at = None
+            else:
+                unreachable.add(receiver_phone)
+                message.delivery_attempts = (message.delivery_attempts or 0) + 1
+                message.next_attempt_at = datetime.utcnow() + timedelta(
+                    seconds=self.retry_delay(message.delivery_attempts)
+                )
+                if message.delivery_attempts >= self.fail_after:
+                    message.set_status('FAILED')
+            if message.status != old_status:
+                changed.append(message)
+        db.session.commit()
+
+        for message in changed:
+            socketio.emit('message_status', {
+                'message_id': message.id,
+                'status': message.status_label
+            }, to=User.room_for(message.sender_id))
+
+# Global outbox, started with the first network manager
+outbox = Outbox()
@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import deque
+
+# Seconds a resolved peer stays valid without being seen again; zeroconf's default host record TTL
+DEFAULT_TTL = 120
+# Past addresses remembered per peer
+ADDRESS_HISTORY = 5
+
+class PeerRecord:
+    """What discovery knows about one peer"""
+    __slots__ = ('phone', 'ip', 'port', 'first_seen', 'last_seen', 'expires', 'addresses')
+
+    def __init__(self, phone, ip, port, now, ttl):
+        self.phone = phone
+        self.ip = ip
+        self.port = port
+        self.first_seen = now
+        self.last_seen = now
+        self.expires = now + ttl
+        self.addresses = deque([(ip, port, now)], maxlen=ADDRESS_HISTORY)
+
+    def to_dict(self, now):
+        return {
+            'ip': self.ip,
+            'port': self.port,
+            'first_seen': time.time() - (now - self.first_seen),
+            'last_seen': time.time() - (now - self.last_seen),
+            'expires_in': max(0.0, self.expires - now),
+            'addresses': [{'ip': ip, 'port': port, 'seen': time.time() - (now - seen)}
+                          for ip, port, seen in self.addresses]
+        }
+
+class PeerCache:
+    """Discovered peers with TTLs, last-seen times and address history.
+
+    Writers (discovery callbacks) take a lock and publish a fresh snapshot;
+    readers (every send and status poll) just read the current snapshot, so
+    they never wait on discovery.
+    """
+    def __init__(self, default_ttl=DEFAULT_TTL):
+        self.default_ttl = default_ttl
+        self._records = {}
+        self._lock = threading.Lock()
+        self._snapshot = {}
+
+    def _publish(self):
+        self._snapshot = {phone: {'ip': record.ip, 'port': record.port}
+                          for phone, record in self._records.items()}
+
+    def snapshot(self):
+        """Read-only {phone: {'ip', 'port'}} of live peers; never blocks"""
+        return self._snapshot
+
+    def get(self, phone):
+        return self._snapshot.get(phone)
+
+    def update(self, phone, ip, port, ttl=None):
+        """Record a sighting; returns True if the peer is new or its address changed"""
+        now = time.monotonic()
+        ttl = ttl or self.default_ttl
+        with self._lock:
+            record = self._records.get(phone)
+            if record is None:
+                self._records[phone] = PeerRecord(phone, ip, port, now, ttl)
+                self._publish()
+                return True
+            record.last_seen = now
+            record.expires = now + ttl
+            if (record.ip, record.port) == (ip, port):
+                return False
+            record.ip, record.port = ip, port
+            record.addresses.append((ip, port, now))
+            self._publish()
+            return True
+
+    def remove(self, phone):
+        """Forget a peer; returns True if it was known"""
+        with self._lock:
+            if self._records.pop(phone, None) is None:
+                return False
+            self._publish()
+            return True
+
+    def expired(self):
+        """Phones whose TTL ran out without a fresh sighting"""
+        now = time.monotonic()
+        with self._lock:
+            return [phone for phone, record in self._records.items() if record.expires <= now]
+
+    def records(self):
+        """Full details of every peer, for diagnostics"""
+        now = time.monotonic()
+        with self._lock:
+            return {phone: record.to_dict(now) for phone, record in self._records.items()}
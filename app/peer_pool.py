@@ -0,0 +1,284 @@
+import asyncio
+import socket
+import threading
+import time
+from app import protocol
+
+# Seconds allowed for connecting to a peer and for it to ack a frame
+CONNECT_TIMEOUT = 5
+ACK_TIMEOUT = 5
+# Connections unused for this long are closed by the reaper
+IDLE_TIMEOUT = 60
+# TCP keepalive: probe after this many idle seconds, then every interval, giving up after count
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_COUNT = 3
+
+def enable_keepalive(sock):
+    """Turn on TCP keepalive, with short probe timings where the platform allows"""
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE),
+                          ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL),
+                          ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+class PeerConnection:
+    """One long-lived framed connection to a peer; callers hold ``lock`` while using it"""
+    def __init__(self, address):
+        self.address = address
+        self.lock = threading.Lock()
+        self.sock = None
+        self.decoder = None
+        self.last_used = time.monotonic()
+
+    def connect(self):
+        self.sock = socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        enable_keepalive(self.sock)
+        self.sock.settimeout(ACK_TIMEOUT)
+        self.decoder = protocol.FrameDecoder()
+
+    def request(self, message, body=None):
+        """Write one JSON frame, and ``body`` as a DATA frame if given, then wait for the peer's JSON reply"""
+        data = protocol.encode_json(message)
+        if body is not None:
+            data += protocol.encode_frame(protocol.FRAME_DATA, body)
+        self.sock.sendall(data)
+        frame = protocol.read_frame(self.sock, self.decoder)
+        if frame is None:
+            raise ConnectionError('Peer closed the connection')
+        self.last_used = time.monotonic()
+        return protocol.decode_json(frame[1])
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+        self.sock = None
+
+class PeerConnectionPool:
+    """Keeps one warm connection per peer for outbound messages.
+
+    Connections are opened on first use, re-opened when discovery reports a
+    new address or a reused socket turns out to be dead, and closed once idle
+    for ``idle_timeout`` seconds.
+    """
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._reaper = None
+
+    def start(self):
+        self._stopped.clear()
+        self._reaper = threading.Thread(target=self._reap, daemon=True)
+        self._reaper.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+    def _connection(self, phone, address):
+        with self._lock:
+            connection = self._connections.get(phone)
+            if connection is None or connection.address != address:
+                stale = connection
+                connection = self._connections[phone] = PeerConnection(address)
+            else:
+                stale = None
+        if stale:
+            with stale.lock:
+                stale.close()
+        return connection
+
+    def request(self, phone, address, message, body=None):
+        """Send ``message`` to a peer and return its reply, reconnecting once if a pooled socket was dead.
+
+        The retry may still repeat a message the peer received just before the
+        socket died; receivers drop repeated message_ids.
+        """
+        connection = self._connection(phone, address)
+        with connection.lock:
+            reused = connection.sock is not None
+            if not reused:
+                connection.connect()
+            try:
+                return connection.request(message, body)
+            except (OSError, protocol.ProtocolError) as e:
+                connection.close()
+                # After a timeout or a bad reply the peer may already have the message
+                if not reused or isinstance(e, (socket.timeout, protocol.ProtocolError)):
+                    raise
+            # The peer dropped a pooled socket since its last use: retry on a fresh one
+            connection.connect()
+            try:
+                return connection.request(message, body)
+            except (OSError, protocol.ProtocolError):
+                connection.close()
+                raise
+
+    def update_address(self, phone, address):
+        """Drop a peer's connection if discovery now reports it somewhere else"""
+        with self._lock:
+            connection = self._connections.get(phone)
+            if connection is None or connection.address == address:
+                return
+            del self._connections[phone]
+        with connection.lock:
+            connection.close()
+
+    def discard(self, phone):
+        with self._lock:
+            connection = self._connections.pop(phone, None)
+        if connection:
+            with connection.lock:
+                connection.close()
+
+    def evict_idle(self):
+        """Close connections that have not been used for ``idle_timeout`` seconds"""
+        cutoff = time.monotonic() - self.idle_timeout
+        with self._lock:
+            idle = [(phone, connection) for phone, connection in self._connections.items()
+                    if connection.last_used < cutoff]
+            for phone, _ in idle:
+                del self._connections[phone]
+        for _, connection in idle:
+            with connection.lock:
+                connection.close()
+        return len(idle)
+
+    def _reap(self):
+        while not self._stopped.wait(self.idle_timeout / 2):
+            try:
+                self.evict_idle()
+            except Exception as e:
+                print(f"Error evicting idle connections: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'connections': len(self._connections),
+                'open': sum(1 for c in self._connections.values() if c.sock is not None)
+            }
+
+class AsyncPeerConnection:
+    """asyncio counterpart of PeerConnection; callers hold ``lock`` while using it"""
+    def __init__(self, address):
+        self.address = address
+        self.lock = asyncio.Lock()
+        self.reader = None
+        self.writer = None
+        self.last_used = time.monotonic()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(*self.address), CONNECT_TIMEOUT
+        )
+        sock = self.writer.get_extra_info('socket')
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        enable_keepalive(sock)
+
+    async def request(self, message, body=None):
+        self.writer.write(protocol.encode_json(message))
+        if body is not None:
+            self.writer.write(protocol.encode_frame(protocol.FRAME_DATA, body))
+        await self.writer.drain()
+        frame = await asyncio.wait_for(protocol.read_frame_async(self.reader), ACK_TIMEOUT)
+        if frame is None:
+            raise ConnectionError('Peer closed the connection')
+        self.last_used = time.monotonic()
+        return protocol.decode_json(frame[1])
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+class AsyncPeerConnectionPool:
+    """PeerConnectionPool for an event loop; every method runs on that loop's thread"""
+    def __init__(self, idle_timeout=IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self._connections = {}
+        self._reaper = None
+
+    def start(self):
+        self._reaper = asyncio.get_running_loop().create_task(self._reap())
+
+    def stop(self):
+        if self._reaper:
+            self._reaper.cancel()
+        for connection in self._connections.values():
+            connection.close()
+        self._connections.clear()
+
+    def _connection(self, phone, address):
+        connection = self._connections.get(phone)
+        if connection is None or connection.address != address:
+            if connection:
+                connection.close()
+            connection = self._connections[phone] = AsyncPeerConnection(address)
+        return connection
+
+    async def request(self, phone, address, message, body=None):
+        """Send ``message`` to a peer and return its reply, reconnecting once if a pooled socket was dead.
+
+        The retry may still repeat a message the peer received just before the
+        socket died; receivers drop repeated message_ids.
+        """
+        connection = self._connection(phone, address)
+        async with connection.lock:
+            reused = connection.writer is not None
+            if not reused:
+                await connection.connect()
+            try:
+                return await connection.request(message, body)
+            except (OSError, asyncio.TimeoutError, protocol.ProtocolError) as e:
+                connection.close()
+                # After a timeout or a bad reply the peer may already have the message
+                if not reused or isinstance(e, (asyncio.TimeoutError, protocol.ProtocolError)):
+                    raise
+            # The peer dropped a pooled socket since its last use: retry on a fresh one
+            await connection.connect()
+            try:
+                return await connection.request(message, body)
+            except (OSError, asyncio.TimeoutError, protocol.ProtocolError):
+                connection.close()
+                raise
+
+    def update_address(self, phone, address):
+        connection = self._connections.get(phone)
+        if connection and connection.address != address:
+            del self._connections[phone]
+            connection.close()
+
+    def discard(self, phone):
+        connection = self._connections.pop(phone, None)
+        if connection:
+            connection.close()
+
+    def evict_idle(self):
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [phone for phone, connection in self._connections.items()
+                if connection.last_used < cutoff and not connection.lock.locked()]
+        for phone in idle:
+            self._connections.pop(phone).close()
+        return len(idle)
+
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(self.idle_timeout / 2)
+            self.evict_idle()
+
+    def stats(self):
+        return {
+            'connections': len(self._connections),
+            'open': sum(1 for c in self._connections.values() if c.writer is not None)
+        }
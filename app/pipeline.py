@@ -0,0 +1,154 @@
+import threading
+import time
+from collections import deque
+from queue import Queue, Empty
+from app import db
+from app.models import Message, add_message
+
+class MessageWriter:
+    """Write-behind pipeline that group-commits new chat messages.
+
+    Messages submitted from request handlers are buffered for at most
+    ``max_delay`` seconds or ``max_rows`` rows and inserted in a single
+    transaction. Each message's callback runs only once its batch is
+    durable, with the message id assigned. If the batch fails to commit,
+    its rows are retried one transaction each so a single bad row does not
+    take the others with it.
+    """
+    def __init__(self, app=None):
+        self.app = None
+        self.running = False
+        self.queue = Queue()
+        self.max_rows = 64
+        self.max_delay = 0.005
+        self.performance_metrics = {
+            'batch_sizes': deque(maxlen=1000),
+            'commit_latencies': deque(maxlen=1000)
+        }
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_rows = app.config['MESSAGE_BATCH_MAX_ROWS']
+        self.max_delay = app.config['MESSAGE_BATCH_MAX_DELAY']
+
+    def start(self):
+        self.running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the writer after committing everything already submitted"""
+        if self.running:
+            self.running = False
+            self.queue.put(None)
+            self._thread.join()
+
+    def submit(self, message, on_durable, on_failed=None):
+        """Queue a transient Message; ``on_durable(message)`` runs after commit.
+
+        ``on_failed(message)`` runs instead if the message could not be stored.
+        """
+        self.queue.put((message, on_durable, on_failed, time.monotonic()))
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = item[3] + self.max_delay
+
+            # Gather more rows until the batch is full or the oldest row has waited long enough
+            while len(batch) < self.max_rows:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._commit(batch)
+
+    def _commit(self, batch):
+        with self.app.app_context():
+            try:
+                for message, _, _, _ in batch:
+                    add_message(message)
+                db.session.flush()
+                ids = [message.id for message, _, _, _ in batch]
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error committing message batch, retrying row by row: {e}")
+                self._commit_rows(batch)
+                return
+
+            self._record_metrics(batch)
+
+            # Reload the expired batch in one round trip rather than one per message
+            Message.query.filter(Message.id.in_(ids)).all()
+
+            for message, on_durable, _, _ in batch:
+                self._notify(on_durable, message)
+
+    def _commit_rows(self, batch):
+        """Commit each row of a failed batch on its own"""
+        committed = []
+        for message, on_durable, on_failed, submitted_at in batch:
+            # The rolled-back row still carries the id and conversation of the failed flush
+            message = _fresh_copy(message)
+            try:
+                add_message(message)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error committing message from user {message.sender_id}: {e}")
+                if on_failed is not None:
+                    self._notify(on_failed, message)
+                continue
+            self._notify(on_durable, message)
+            committed.append((message, on_durable, on_failed, submitted_at))
+        if committed:
+            self._record_metrics(committed)
+
+    def _record_metrics(self, batch):
+        committed_at = time.monotonic()
+        self.performance_metrics['batch_sizes'].append(len(batch))
+        self.performance_metrics['commit_latencies'].extend(
+            committed_at - submitted_at for _, _, _, submitted_at in batch
+        )
+
+    @staticmethod
+    def _notify(callback, message):
+        try:
+            callback(message)
+        except Exception as e:
+            print(f"Error notifying sender of message {message.id}: {e}")
+
+    def get_performance_metrics(self):
+        """Get batch-size and submit-to-durable latency metrics"""
+        batch_sizes = list(self.performance_metrics['batch_sizes'])
+        latencies = list(self.performance_metrics['commit_latencies'])
+        return {
+            'batches': len(batch_sizes),
+            'avg_batch_size': sum(batch_sizes) / len(batch_sizes) if batch_sizes else 0,
+            'max_batch_size': max(batch_sizes) if batch_sizes else 0,
+            'avg_commit_latency': sum(latencies) / len(latencies) if latencies else 0,
+            'max_commit_latency': max(latencies) if latencies else 0
+        }
+
+def _fresh_copy(message):
+    """A transient Message with the same column values, minus the database-assigned ones"""
+    return Message(**{
+        column.key: getattr(message, column.key)
+        for column in Message.__table__.columns
+        if column.key not in ('id', 'conversation_id')
+    })
+
+# Global message writer instance, started when MESSAGE_GROUP_COMMIT is enabled
+message_writer = MessageWriter()
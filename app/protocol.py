@@ -0,0 +1,159 @@
+"""Length-prefixed framing for the LAN TCP transport.
+
+Every frame is a fixed header followed by its payload::
+
+    version (1 byte) | payload length (4 bytes, big-endian) | type (1 byte) | payload
+
+JSON frames carry control and chat messages. DATA frames carry raw bytes,
+such as a file body; they may be far larger than a JSON frame, so a reader
+takes the header with ``next_header`` and streams the payload itself.
+"""
+import asyncio
+import json
+import struct
+
+VERSION = 1
+HEADER = struct.Struct('!BIB')
+
+# Frame types
+FRAME_JSON = 1
+FRAME_DATA = 2
+FRAME_TYPES = (FRAME_JSON, FRAME_DATA)
+
+# Largest payload the decoder will buffer; bigger bodies must be streamed
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Bytes requested per recv() when filling a decoder from a socket
+RECV_SIZE = 64 * 1024
+
+class ProtocolError(Exception):
+    """The peer sent bytes that are not a valid frame"""
+
+def encode_header(frame_type, length):
+    return HEADER.pack(VERSION, length, frame_type)
+
+def encode_frame(frame_type, payload):
+    return encode_header(frame_type, len(payload)) + payload
+
+def encode_json(message):
+    return encode_frame(FRAME_JSON, json.dumps(message).encode())
+
+def decode_json(payload):
+    try:
+        return json.loads(payload)
+    except ValueError as e:
+        raise ProtocolError(f'Invalid JSON payload: {e}')
+
+def decode_header(data, offset=0):
+    """(type, length) of the header at ``offset``, rejecting unknown versions and types"""
+    version, length, frame_type = HEADER.unpack_from(data, offset)
+    if version != VERSION:
+        raise ProtocolError(f'Unsupported protocol version {version}')
+    if frame_type not in FRAME_TYPES:
+        raise ProtocolError(f'Unknown frame type {frame_type}')
+    return frame_type, length
+
+class FrameDecoder:
+    """Incremental decoder for a byte stream of frames.
+
+    Bytes can be fed in arbitrary pieces: partial headers and payloads are
+    buffered until complete, and several pipelined frames in one read are
+    returned one by one.
+    """
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+
+    def buffered(self):
+        return len(self._buffer)
+
+    def _peek_header(self):
+        if len(self._buffer) < HEADER.size:
+            return None
+        return decode_header(self._buffer)
+
+    def next_header(self):
+        """Pop the next frame header as (type, length), leaving its payload unread"""
+        header = self._peek_header()
+        if header:
+            del self._buffer[:HEADER.size]
+        return header
+
+    def take(self, size):
+        """Pop up to ``size`` buffered payload bytes"""
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def next_frame(self):
+        """Pop the next complete frame as (type, payload), or None if more bytes are needed"""
+        header = self._peek_header()
+        if not header:
+            return None
+        frame_type, length = header
+        if length > self.max_frame_size:
+            raise ProtocolError(f'Frame of {length} bytes exceeds the {self.max_frame_size} byte limit')
+        end = HEADER.size + length
+        if len(self._buffer) < end:
+            return None
+        payload = bytes(self._buffer[HEADER.size:end])
+        del self._buffer[:end]
+        return frame_type, payload
+
+    def frames(self):
+        """Iterate over every complete frame buffered so far"""
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+def read_frame(sock, decoder):
+    """Block until the next complete frame arrives; None once the peer closes cleanly"""
+    while True:
+        frame = decoder.next_frame()
+        if frame:
+            return frame
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            if decoder.buffered():
+                raise ProtocolError('Connection closed mid-frame')
+            return None
+        decoder.feed(data)
+
+def read_header(sock, decoder):
+    """Block until the next frame header arrives, for frames whose payload is streamed"""
+    while True:
+        header = decoder.next_header()
+        if header:
+            return header
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            raise ProtocolError('Connection closed mid-frame')
+        decoder.feed(data)
+
+async def read_header_async(reader):
+    """Next frame header from an asyncio stream; None once the peer closes cleanly"""
+    try:
+        data = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ProtocolError('Connection closed mid-frame')
+        return None
+    return decode_header(data)
+
+async def read_frame_async(reader, max_frame_size=MAX_FRAME_SIZE):
+    """Next complete frame from an asyncio stream; None once the peer closes cleanly"""
+    header = await read_header_async(reader)
+    if header is None:
+        return None
+    frame_type, length = header
+    if length > max_frame_size:
+        raise ProtocolError(f'Frame of {length} bytes exceeds the {max_frame_size} byte limit')
+    try:
+        return frame_type, await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ProtocolError('Connection closed mid-frame')
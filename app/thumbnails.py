@@ -0,0 +1,57 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Thumbnails are optional; without Pillow originals are served
+    Image = None
+
+JPEG_QUALITY = 80
+
+# Background pool that renders thumbnails right after an image is uploaded
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='thumbnails')
+
+def available():
+    return Image is not None
+
+def thumb_path(original_path, size):
+    """Thumbnails live next to their original as <original>.<size>.jpg"""
+    return f'{original_path}.{size}.jpg'
+
+def render(original_path, sizes):
+    """Write a JPEG thumbnail of ``original_path`` for each ``{name: max_px}`` entry"""
+    with Image.open(original_path) as image:
+        # Let the JPEG decoder downscale while decoding when it can
+        image.draft('RGB', (max(sizes.values()),) * 2)
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        for name, max_px in sizes.items():
+            thumb = image.copy()
+            thumb.thumbnail((max_px, max_px))
+            path = thumb_path(original_path, name)
+            # Write then rename so readers never see a partial thumbnail
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                thumb.save(f, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+            os.replace(tmp_path, path)
+
+def ensure(original_path, size, max_px):
+    """Path of a thumbnail, rendering it first on a cache miss"""
+    path = thumb_path(original_path, size)
+    if not os.path.exists(path):
+        render(original_path, {size: max_px})
+    return path
+
+def _render_quietly(original_path, sizes):
+    try:
+        render(original_path, sizes)
+    except Exception as e:
+        print(f"Error rendering thumbnails for {original_path}: {e}")
+
+def schedule(original_path, sizes):
+    """Render all thumbnail sizes for a new upload in the background"""
+    if available():
+        _executor.submit(_render_quietly, original_path, dict(sizes))
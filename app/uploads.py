@@ -0,0 +1,119 @@
+import hashlib
+import os
+import threading
+from datetime import datetime, timedelta
+from app import db, blobstore
+from app.models import Upload
+
+# Bytes read from the request stream or disk per write/hash step
+BLOCK_SIZE = 64 * 1024
+
+# In-memory SHA-256 state per upload: the digest covers every chunk below next_chunk
+_hash_states = {}
+_hash_states_lock = threading.Lock()
+
+class _HashState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sha256 = hashlib.sha256()
+        self.next_chunk = 0
+
+def _hash_state(upload_id):
+    with _hash_states_lock:
+        return _hash_states.setdefault(upload_id, _HashState())
+
+def partial_path(upload):
+    """Where an in-progress upload is written before it moves into the blob store"""
+    return os.path.join(blobstore.staging_dir(), f'{upload.id}.part')
+
+def preallocate(upload):
+    """Create the partial file at its final size so chunks can land in any order"""
+    with open(partial_path(upload), 'wb') as f:
+        if upload.size and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, upload.size)
+        else:
+            f.truncate(upload.size)
+
+def write_chunk(upload, index, stream):
+    """Stream one chunk from ``stream`` into place in the partial file.
+
+    Returns False if the stream did not carry exactly the chunk's length, in
+    which case the chunk must be resent. When the chunk is the next one the
+    running digest needs, it is hashed on the way through.
+    """
+    expected = upload.chunk_length(index)
+    state = _hash_state(upload.id)
+    sha256 = state.sha256.copy() if state.next_chunk == index else None
+    written = 0
+
+    with open(partial_path(upload), 'r+b') as f:
+        f.seek(index * upload.chunk_size)
+        while written < expected:
+            block = stream.read(min(BLOCK_SIZE, expected - written))
+            if not block:
+                break
+            f.write(block)
+            if sha256:
+                sha256.update(block)
+            written += len(block)
+
+    if written != expected or stream.read(1):
+        return False
+
+    if sha256:
+        with state.lock:
+            if state.next_chunk == index:
+                state.sha256 = sha256
+                state.next_chunk = index + 1
+    return True
+
+def advance_hash(upload):
+    """Fold any chunks that are now contiguous with the hashed prefix into the digest"""
+    state = _hash_state(upload.id)
+    with state.lock:
+        if state.next_chunk >= upload.chunk_count or not upload.has_chunk(state.next_chunk):
+            return
+        with open(partial_path(upload), 'rb') as f:
+            while state.next_chunk < upload.chunk_count and upload.has_chunk(state.next_chunk):
+                f.seek(state.next_chunk * upload.chunk_size)
+                remaining = upload.chunk_length(state.next_chunk)
+                while remaining > 0:
+                    block = f.read(min(BLOCK_SIZE, remaining))
+                    state.sha256.update(block)
+                    remaining -= len(block)
+                state.next_chunk += 1
+
+def finish_hash(upload):
+    """Hex SHA-256 of the complete upload, rehashing from disk if state was lost"""
+    advance_hash(upload)
+    with _hash_states_lock:
+        state = _hash_states.pop(upload.id, None)
+    if state and state.next_chunk >= upload.chunk_count:
+        return state.sha256.hexdigest()
+
+    sha256 = hashlib.sha256()
+    with open(partial_path(upload), 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+def discard(upload):
+    """Forget an upload's hash state and remove its partial file"""
+    with _hash_states_lock:
+        _hash_states.pop(upload.id, None)
+    try:
+        os.remove(partial_path(upload))
+    except OSError:
+        pass
+
+def expire_stale(max_age):
+    """Delete upload sessions started more than ``max_age`` seconds ago, with their partial files"""
+    cutoff = datetime.utcnow() - timedelta(seconds=max_age)
+    stale = Upload.query.filter(Upload.created < cutoff).all()
+    if not stale:
+        return
+    for upload in stale:
+        db.session.delete(upload)
+    db.session.commit()
+    for upload in stale:
+        discard(upload)
@@ -0,0 +1,62 @@
+"""Time decrypting one history page: decrypt_message per row versus decrypt_many.
+
+The page mixes messages from the peer with our own sent ones, like a real
+conversation. It runs for short chat messages and for larger pasted text:
+
+    python benchmarks/decrypt_page.py [page_size]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.encryption import E2EEncryption, DECRYPT_WORKERS
+
+
+def session_pair():
+    """Alice and Bob sessions that share one root key, as a completed handshake would"""
+    alice, bob = E2EEncryption(1), E2EEncryption(2)
+    alice.initialize_session(bob.get_public_bundle(), 2)
+    bob.initialize_session(alice.get_public_bundle(), 1)
+    bob_ratchet = bob.sessions[1]['ratchet']
+    bob_ratchet.root_key = alice.sessions[2]['ratchet'].root_key
+    bob_ratchet.init_chains(2, 1)
+    return alice, bob
+
+
+def run(page_size, message_size, rounds=5):
+    alice, bob = session_pair()
+    rows, expected = [], []
+    for n in range(page_size):
+        text = f'{n:08d}'.ljust(message_size, 'x')
+        if n % 3:
+            rows.append((alice.encrypt_message(text, 2), 1, 2))
+        else:
+            rows.append((bob.encrypt_message(text, 1), 2, 1))
+        expected.append(text)
+    incoming = [(envelope, sender) for envelope, sender, _ in rows if sender == 1]
+
+    # Serial baseline: what get_messages could do before, one call per incoming row
+    best_serial = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for envelope, sender in incoming:
+            bob.decrypt_message(envelope, sender)
+        best_serial = min(best_serial, (time.perf_counter() - started) / len(incoming))
+
+    best_batch = float('inf')
+    for _ in range(rounds):
+        started = time.perf_counter()
+        plaintexts = bob.decrypt_many(rows)
+        best_batch = min(best_batch, (time.perf_counter() - started) / len(rows))
+    assert plaintexts == expected
+
+    print(f'{page_size} messages of {message_size:6d} bytes: decrypt_message {best_serial * 1e6:7.1f} us/msg, '
+          f'decrypt_many {best_batch * 1e6:7.1f} us/msg ({best_serial / best_batch:4.1f}x, {DECRYPT_WORKERS} workers)')
+
+
+if __name__ == '__main__':
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    for message_size in (64, 1024, 16384, 65536):
+        run(page_size, message_size)
@@ -0,0 +1,48 @@
+"""Compare the legacy JSON envelope with the binary one: stored size and pack/unpack cost.
+
+    python benchmarks/envelope.py
+"""
+import json
+import os
+import sys
+import time
+from base64 import b64encode
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.encryption import pack_envelope, unpack_envelope
+
+ROUNDS = 20000
+
+
+def pack_json(message_number, nonce, ciphertext):
+    """What encrypt_message returned before the binary envelope"""
+    return json.dumps({
+        'ciphertext': b64encode(ciphertext).decode(),
+        'nonce': b64encode(nonce).decode(),
+        'message_number': message_number
+    })
+
+
+def per_call(fn):
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        fn()
+    return (time.perf_counter() - started) / ROUNDS * 1e6
+
+
+def main():
+    nonce = os.urandom(12)
+    for size in (16, 256, 4096, 65536):
+        ciphertext = os.urandom(size + 16)  # plaintext plus the GCM tag
+        legacy = pack_json(1234, nonce, ciphertext)
+        binary = pack_envelope(1234, nonce, ciphertext)
+        assert unpack_envelope(legacy)[2] == unpack_envelope(binary)[2] == ciphertext
+        print(f'{size:6d} byte message: json {len(legacy):6d} B, pack {per_call(lambda: pack_json(1234, nonce, ciphertext)):6.2f} us, '
+              f'unpack {per_call(lambda: unpack_envelope(legacy)):6.2f} us | '
+              f'binary {len(binary):6d} B, pack {per_call(lambda: pack_envelope(1234, nonce, ciphertext)):6.2f} us, '
+              f'unpack {per_call(lambda: unpack_envelope(binary)):6.2f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Fuzz and measure the LAN transport's frame decoder.
+
+The fuzz pass checks that pipelined frames survive arbitrary read
+boundaries. It also checks that corrupted streams only ever raise
+ProtocolError. The throughput pass pushes JSON frames through a
+socketpair and decodes them on the other side:
+
+    python benchmarks/framing.py [fuzz-rounds] [messages]
+"""
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import protocol
+
+PAYLOAD_SIZES = (0, 1, 80, 4096, 4097, 70000)
+
+
+def random_frames(rng, count):
+    frames = []
+    for _ in range(count):
+        size = rng.choice(PAYLOAD_SIZES)
+        frame_type = rng.choice(protocol.FRAME_TYPES)
+        frames.append((frame_type, rng.randbytes(size)))
+    return frames
+
+
+def split_randomly(rng, data):
+    pieces, i = [], 0
+    while i < len(data):
+        step = rng.choice((1, 2, 5, protocol.HEADER.size, 1000, 65536))
+        pieces.append(data[i:i + step])
+        i += step
+    return pieces
+
+
+def fuzz(rounds, seed=1234):
+    rng = random.Random(seed)
+    for _ in range(rounds):
+        frames = random_frames(rng, rng.randint(1, 8))
+        stream = b''.join(protocol.encode_frame(t, p) for t, p in frames)
+
+        decoder = protocol.FrameDecoder()
+        decoded = []
+        for piece in split_randomly(rng, stream):
+            decoder.feed(piece)
+            decoded.extend(decoder.frames())
+        assert decoded == frames, 'round trip mismatch'
+        assert decoder.buffered() == 0
+
+        # Flip bytes and truncate: the decoder may wait for more data or reject, never misbehave
+        corrupt = bytearray(stream)
+        for _ in range(rng.randint(1, 4)):
+            corrupt[rng.randrange(len(corrupt))] = rng.randrange(256)
+        corrupt = corrupt[:rng.randint(0, len(corrupt))]
+        decoder = protocol.FrameDecoder()
+        try:
+            for piece in split_randomly(rng, bytes(corrupt)):
+                decoder.feed(piece)
+                for frame_type, payload in decoder.frames():
+                    assert frame_type in protocol.FRAME_TYPES
+                    assert len(payload) <= decoder.max_frame_size
+        except protocol.ProtocolError:
+            pass
+    print(f'fuzz: {rounds} rounds ok')
+
+
+def throughput(messages, payload_size=200):
+    sender, receiver = socket.socketpair()
+    frame = protocol.encode_json({'type': 'message', 'content': 'x' * payload_size})
+    received = [0]
+
+    def consume():
+        decoder = protocol.FrameDecoder()
+        while protocol.read_frame(receiver, decoder):
+            received[0] += 1
+
+    consumer = threading.Thread(target=consume)
+    started = time.perf_counter()
+    consumer.start()
+    for _ in range(messages):
+        sender.sendall(frame)
+    sender.close()
+    consumer.join()
+    elapsed = time.perf_counter() - started
+    receiver.close()
+
+    assert received[0] == messages
+    print(f'throughput: {messages} frames of {len(frame)} bytes in {elapsed:.2f}s '
+          f'= {messages / elapsed:,.0f} msgs/s, {messages * len(frame) / elapsed / 1e6:.1f} MB/s')
+
+
+if __name__ == '__main__':
+    fuzz(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
+    throughput(int(sys.argv[2]) if len(sys.argv) > 2 else 200000)
@@ -0,0 +1,68 @@
+"""Startup and per-message cost of the persistent keystore.
+
+Fills a keystore with many peer sessions. It then compares a restart that
+loads only the identity (sessions load on first use) with loading every
+session eagerly, and a fresh in-memory manager generating its pre-keys.
+It also measures the chain write-back on encrypt_message:
+
+    python benchmarks/keystore.py [peers]
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives.asymmetric import x25519
+from app.encryption import E2EEncryption, CHAIN_CHECKPOINT_INTERVAL, MAX_CACHED_MESSAGE_KEYS, PRE_KEY_POOL_SIZE
+from app.keystore import Keystore
+
+MESSAGES = 2000
+
+
+def timed(label, fn, count=1):
+    started = time.perf_counter()
+    result = fn()
+    elapsed = (time.perf_counter() - started) / count
+    unit, scale = ('ms', 1e3) if elapsed >= 1e-3 else ('us', 1e6)
+    print(f'  {label:46s} {elapsed * scale:8.2f} {unit}')
+    return result
+
+
+def main(peers):
+    path = os.path.join(tempfile.mkdtemp(), 'keys.db')
+    manager = E2EEncryption(0, Keystore(path))
+    bundle = E2EEncryption(-1).get_public_bundle()
+    for peer_id in range(1, peers + 1):
+        manager.initialize_session(bundle, peer_id)
+    manager.close()
+
+    print(f'startup with {peers} stored sessions')
+    timed('old: generate identity and 20 pre-keys inline',
+          lambda: [x25519.X25519PrivateKey.generate() for _ in range(PRE_KEY_POOL_SIZE + 2)])
+    restarted = timed('new: open keystore, load identity',
+                      lambda: E2EEncryption(0, Keystore(path)))
+    timed(f'eager: also load all {peers} sessions',
+          lambda: [restarted._session(peer_id) for peer_id in range(1, peers + 1)])
+    fresh = E2EEncryption(0, Keystore(path))
+    timed('lazy: first use of one session', lambda: fresh._session(peers // 2))
+
+    print(f'encrypt_message, {MESSAGES} messages to one peer')
+    in_memory = E2EEncryption(0)
+    in_memory.initialize_session(bundle, 1)
+    timed('in memory', lambda: [in_memory.encrypt_message('hello', 1) for _ in range(MESSAGES)], MESSAGES)
+    timed('with chain write-back', lambda: [fresh.encrypt_message('hello', 1) for _ in range(MESSAGES)], MESSAGES)
+    fresh.close()
+
+    # A restart resumes the chain where it stopped, and only the window's checkpoints stay on disk
+    reopened = E2EEncryption(0, Keystore(path))
+    chain = reopened._session(1)['ratchet'].send_chain
+    assert chain.index == MESSAGES
+    stored = reopened.keystore._db.execute('SELECT COUNT(*) FROM checkpoint WHERE peer_id = 1').fetchone()[0]
+    assert stored <= 2 * (MAX_CACHED_MESSAGE_KEYS // CHAIN_CHECKPOINT_INTERVAL + 2), stored
+    reopened.close()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
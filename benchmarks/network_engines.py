@@ -0,0 +1,100 @@
+"""Compare the threaded and asyncio LAN transport engines under many peers.
+
+A receiving engine of each kind listens on localhost, with zeroconf and
+the database consumer turned off. Simulated peers open one connection each
+and send chat frames, waiting for every ack as the connection pool does.
+The run reports msgs/s and the receiver's peak thread count:
+
+    python benchmarks/network_engines.py [peers ...] [--messages N]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import protocol
+from app.network import NetworkManager
+from app.network_async import AsyncNetworkManager
+
+
+def transport_only(engine):
+    class Engine(engine):
+        tcp_port = 0
+
+        def _start_discovery(self):
+            pass
+
+        def _stop_discovery(self):
+            pass
+
+        async def _start_discovery_async(self):
+            pass
+
+        async def _stop_discovery_async(self):
+            pass
+
+        def _process_message_queue(self):
+            while self.running:
+                item = self.message_queue.get()
+                if item is not None:
+                    # Acked as stored without touching the database
+                    self._finish([item], [(item, None)])
+    Engine.__name__ = engine.__name__
+    return Engine
+
+
+async def peer(port, index, messages):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for n in range(messages):
+        writer.write(protocol.encode_json({
+            'type': 'message', 'message_id': n, 'sender_phone': f'peer-{index}', 'content': f'message {n}'
+        }))
+        await writer.drain()
+        frame = await protocol.read_frame_async(reader)
+        assert protocol.decode_json(frame[1])['status'] == 'ok'
+    writer.close()
+    await writer.wait_closed()
+
+
+def run(engine, peers, messages):
+    manager = transport_only(engine)('bench')
+    # The threaded server's accept backlog is otherwise the bottleneck at high peer counts
+    manager.tcp_socket.listen(max(peers, 5))
+    manager.start()
+    baseline = threading.active_count()
+    peak = [baseline]
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(0.01):
+            peak[0] = max(peak[0], threading.active_count())
+    sampler = threading.Thread(target=sample, daemon=True)
+    sampler.start()
+
+    async def main():
+        await asyncio.gather(*(peer(manager.tcp_port, i, messages) for i in range(peers)))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    elapsed = time.perf_counter() - started
+    done.set()
+    sampler.join()
+    manager.stop()
+
+    total = peers * messages
+    print(f'{engine.__name__:20s} peers={peers:4d} msgs={total:7d} '
+          f'{total / elapsed:9,.0f} msgs/s  receiver threads: {baseline} idle, {peak[0]} peak')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('peers', nargs='*', type=int, default=[10, 100, 500])
+    parser.add_argument('--messages', type=int, default=200)
+    args = parser.parse_args()
+    for peers in args.peers:
+        for engine in (NetworkManager, AsyncNetworkManager):
+            run(engine, peers, args.messages)
@@ -0,0 +1,111 @@
+"""Measure discovery latency with a hundred simulated zeroconf services.
+
+A fake Zeroconf answers get_service_info after a per-service delay. Most
+peers answer in a few milliseconds, but a handful take the full resolve
+timeout. The browser callbacks fire back to back, as they do on a busy
+LAN. The benchmark compares resolving inline in the callback (the old
+behaviour) with the worker pool, reporting when each peer appeared in the
+snapshot and the cost of reading it:
+
+    python benchmarks/peer_discovery.py [services] [slow]
+"""
+import os
+import random
+import socket
+import statistics
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from zeroconf import ServiceInfo
+from app import network
+from app.network import NetworkManager
+
+SERVICE_TYPE = '_chatapp._tcp.local.'
+FAST_DELAY = (0.002, 0.02)
+SLOW_DELAY = 3.0  # an unresponsive peer costs the whole resolve timeout
+
+
+class FakeZeroconf:
+    def __init__(self, delays):
+        self.delays = delays
+
+    def get_service_info(self, type_, name, timeout=3000):
+        time.sleep(self.delays[name])
+        phone = name[:-len(SERVICE_TYPE) - 1]
+        index = int(phone.rsplit('-', 1)[1])
+        return ServiceInfo(
+            type_, name,
+            addresses=[socket.inet_aton(f'10.0.{index // 250}.{index % 250 + 1}')],
+            port=12345,
+            properties={'phone': phone.encode()}
+        )
+
+
+class Manager(NetworkManager):
+    tcp_port = 0
+
+    def _queue_presence(self, peer_phone, online):
+        pass
+
+
+def run(services, slow, pooled, seed=7):
+    rng = random.Random(seed)
+    names = [f'peer-{i}.{SERVICE_TYPE}' for i in range(services)]
+    slow_names = set(rng.sample(names, slow))
+    delays = {name: SLOW_DELAY if name in slow_names else rng.uniform(*FAST_DELAY) for name in names}
+    zc = FakeZeroconf(delays)
+
+    manager = Manager('bench')
+    network.outbox.peer_online = lambda phone: None
+    if not pooled:
+        # Old behaviour: resolve inside the browser callback
+        manager.add_service = lambda zc, type_, name: manager._peer_discovered(zc.get_service_info(type_, name))
+
+    started = time.perf_counter()
+    seen = {}
+
+    def watch():
+        while len(seen) < services and time.perf_counter() - started < SLOW_DELAY * services:
+            now = time.perf_counter() - started
+            for phone in manager.peers:
+                seen.setdefault(phone, now)
+            time.sleep(0.001)
+    watcher = threading.Thread(target=watch)
+    watcher.start()
+
+    for name in names:  # the browser thread delivers callbacks one after another
+        manager.add_service(zc, SERVICE_TYPE, name)
+    watcher.join()
+    manager._resolver.shutdown()
+    manager.tcp_socket.close()
+
+    # Every service resolved once, to the address its fake record carried
+    assert len(seen) == services, f'{services - len(seen)} peers never appeared'
+    for index in range(services):
+        assert manager.peers[f'peer-{index}'] == {'ip': f'10.0.{index // 250}.{index % 250 + 1}', 'port': 12345}
+
+    fast = sorted(t for phone, t in seen.items() if f'{phone}.{SERVICE_TYPE}' not in slow_names)
+    reads = 100000
+    read_started = time.perf_counter()
+    for _ in range(reads):
+        manager.peers.get('peer-0')
+    read_cost = (time.perf_counter() - read_started) / reads
+
+    if pooled:
+        # Slow peers must not hold back the rest
+        assert max(fast) < SLOW_DELAY, 'a fast peer waited behind a slow one'
+
+    label = 'worker pool' if pooled else 'inline'
+    print(f'{label:12s} {services} services ({slow} slow): fast peers median {statistics.median(fast) * 1000:7.1f} ms, '
+          f'p95 {fast[int(len(fast) * 0.95) - 1] * 1000:7.1f} ms; all peers {max(seen.values()):5.2f} s; '
+          f'snapshot read {read_cost * 1e9:.0f} ns')
+
+
+if __name__ == '__main__':
+    services = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    slow = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    run(services, slow, pooled=False)
+    run(services, slow, pooled=True)
@@ -0,0 +1,100 @@
+"""Per-message key derivation cost: HKDF over root_key + n versus the KDF chain.
+
+Each case runs both the old derivation and the chain step, for in-order
+messages, messages that arrive in reverse order, and a history page that
+is decrypted again. A chain refuses to skip more than MAX_SKIP messages,
+so ``messages`` is capped there:
+
+    python benchmarks/ratchet.py [messages]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from app.encryption import E2EEncryption, KDFChain, MAX_SKIP, kdf_chain_step
+
+
+def hkdf_message_key(root_key, n):
+    """The derivation encrypt_message and decrypt_message used before the chain"""
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'E2EE-Chat-Message-Key'
+    ).derive(root_key + str(n).encode())
+
+
+def timed(label, count, fn):
+    started = time.perf_counter()
+    fn()
+    per_message = (time.perf_counter() - started) / count
+    print(f'  {label:44s} {per_message * 1e6:8.2f} us/message')
+
+
+def session_pair():
+    """Alice and Bob sessions that share one root key, as a completed handshake would"""
+    alice, bob = E2EEncryption(1), E2EEncryption(2)
+    alice.initialize_session(bob.get_public_bundle(), 2)
+    bob.initialize_session(alice.get_public_bundle(), 1)
+    bob_ratchet = bob.sessions[1]['ratchet']
+    bob_ratchet.root_key = alice.sessions[2]['ratchet'].root_key
+    bob_ratchet.init_chains(2, 1)
+    return alice, bob
+
+
+def main(messages):
+    messages = min(messages, MAX_SKIP)
+    root_key = os.urandom(32)
+    expected = []
+    chain_key = root_key
+    for _ in range(messages):
+        chain_key, message_key = kdf_chain_step(chain_key)
+        expected.append(message_key)
+
+    print('key derivation')
+    timed('HKDF(root_key + n)', messages, lambda: [hkdf_message_key(root_key, n) for n in range(messages)])
+
+    def chain_in_order():
+        chain_key = root_key
+        for _ in range(messages):
+            chain_key, _ = kdf_chain_step(chain_key)
+    timed('chain step (one HMAC)', messages, chain_in_order)
+
+    print('out-of-order receipt (reverse order)')
+    timed('HKDF(root_key + n)', messages,
+          lambda: [hkdf_message_key(root_key, n) for n in reversed(range(messages))])
+
+    reversed_keys = []
+    def chain_reversed():
+        chain = KDFChain(root_key)
+        for n in reversed(range(messages)):
+            reversed_keys.append(chain.key_for(n))
+    timed('chain, skipped keys cached', messages, chain_reversed)
+    assert reversed_keys[::-1] == expected
+
+    print('history reload (every key needed again)')
+    chain = KDFChain(root_key)
+    for n in range(messages):
+        chain.key_for(n)
+    timed('HKDF(root_key + n)', messages, lambda: [hkdf_message_key(root_key, n) for n in range(messages)])
+    timed('chain (LRU, then checkpoints)', messages, lambda: [chain.key_for(n) for n in range(messages)])
+    chain.message_keys.clear()
+    assert [chain.key_for(n) for n in range(messages)] == expected, 'checkpoint re-derivation mismatch'
+
+    print('encrypt + decrypt round trip')
+    alice, bob = session_pair()
+    envelopes = []
+    timed('encrypt_message', messages,
+          lambda: envelopes.extend(alice.encrypt_message(f'message {n}', 2) for n in range(messages)))
+    plaintexts = []
+    timed('decrypt_message, reverse order', messages,
+          lambda: plaintexts.extend(bob.decrypt_message(e, 1) for e in reversed(envelopes)))
+    assert plaintexts == [f'message {n}' for n in reversed(range(messages))]
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
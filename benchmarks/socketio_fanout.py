@@ -0,0 +1,68 @@
+"""Benchmark new_message fan-out cost as the number of connected clients grows.
+
+Compares the old broadcast emit against targeting the sender and receiver
+rooms. Uses Flask-SocketIO test clients against an in-memory database:
+
+    python benchmarks/socketio_fanout.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+from app import create_app, db, socketio
+from app.models import User
+
+CLIENT_COUNTS = (10, 100, 1000)
+EMITS = 500
+
+
+class BenchConfig(Config):
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    TESTING = True
+
+
+def connect_clients(app, count):
+    with app.app_context():
+        users = [User(phone_number=f'+1{i:010d}', display_name=f'User {i}') for i in range(count)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [user.id for user in users]
+
+    clients = []
+    for user_id in user_ids:
+        http_client = app.test_client()
+        with http_client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+        clients.append(socketio.test_client(app, flask_test_client=http_client))
+    return user_ids, clients
+
+
+def time_emits(app, **emit_kwargs):
+    payload = {'message': {'id': 1, 'content': 'x' * 64}}
+    with app.app_context():
+        start = time.perf_counter()
+        for _ in range(EMITS):
+            socketio.emit('new_message', payload, **emit_kwargs)
+        return (time.perf_counter() - start) / EMITS
+
+
+def main():
+    print(f'{"clients":>8} {"broadcast us/emit":>18} {"rooms us/emit":>14}')
+    for count in CLIENT_COUNTS:
+        app = create_app(BenchConfig)
+        user_ids, clients = connect_clients(app, count)
+        rooms = [f'user-{user_ids[0]}', f'user-{user_ids[1]}']
+
+        broadcast = time_emits(app)
+        targeted = time_emits(app, to=rooms)
+        print(f'{count:>8} {broadcast * 1e6:>18.1f} {targeted * 1e6:>14.1f}')
+
+        for client in clients:
+            client.disconnect()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Benchmark mixed read/write chat load under the default and production SQLite profiles.
+
+Writer threads insert messages one commit at a time (as handle_message does)
+while reader threads page through conversation history. Each profile runs
+against a fresh database file:
+
+    python benchmarks/sqlite_profiles.py [seconds]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config, ProductionConfig
+from app import create_app, db
+from app.models import User, Message, Conversation, add_message
+
+WRITERS = 4
+READERS = 8
+USERS = 20
+SEED_MESSAGES = 5000
+PAGE_SIZE = 50
+
+
+def make_app(profile, path):
+    class BenchConfig(profile):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{path}'
+        TESTING = True
+    return create_app(BenchConfig)
+
+
+def seed(app):
+    with app.app_context():
+        users = [User(phone_number=f'+1{i:010d}', display_name=f'User {i}') for i in range(USERS)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_ids = [user.id for user in users]
+        for i in range(SEED_MESSAGES):
+            add_message(Message(sender_id=user_ids[i % USERS], receiver_id=user_ids[(i + 1) % USERS],
+                                content=f'seed {i}'))
+        db.session.commit()
+        return user_ids
+
+
+def writer(app, user_ids, stop, counts, errors, index):
+    with app.app_context():
+        n = 0
+        while not stop.is_set():
+            try:
+                add_message(Message(sender_id=user_ids[index], receiver_id=user_ids[(index + 1) % USERS],
+                                    content=f'bench {n}'))
+                db.session.commit()
+                counts['writes'] += 1
+            except Exception:
+                db.session.rollback()
+                errors['writes'] += 1
+            n += 1
+
+
+def reader(app, user_ids, stop, counts, errors, index):
+    with app.app_context():
+        conversation_ids = [Conversation.find(user_ids[i], user_ids[(i + 1) % USERS]).id for i in range(USERS)]
+        n = index
+        while not stop.is_set():
+            try:
+                Message.query.filter(Message.conversation_id == conversation_ids[n % USERS]).order_by(
+                    Message.timestamp.desc(), Message.id.desc()
+                ).limit(PAGE_SIZE).all()
+                db.session.rollback()
+                counts['reads'] += 1
+            except Exception:
+                db.session.rollback()
+                errors['reads'] += 1
+            n += 1
+
+
+def run(profile, seconds):
+    path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    app = make_app(profile, path)
+    user_ids = seed(app)
+
+    stop = threading.Event()
+    counts = {'writes': 0, 'reads': 0}
+    errors = {'writes': 0, 'reads': 0}
+    threads = [threading.Thread(target=writer, args=(app, user_ids, stop, counts, errors, i)) for i in range(WRITERS)]
+    threads += [threading.Thread(target=reader, args=(app, user_ids, stop, counts, errors, i)) for i in range(READERS)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        db.engine.dispose()
+    return counts, errors
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    print(f'{WRITERS} writers, {READERS} readers, {seconds:g}s per profile')
+    print(f'{"profile":>12} {"writes/s":>10} {"reads/s":>10} {"write errors":>13} {"read errors":>12}')
+    for name, profile in (('default', Config), ('production', ProductionConfig)):
+        counts, errors = run(profile, seconds)
+        print(f'{name:>12} {counts["writes"] / seconds:>10.0f} {counts["reads"] / seconds:>10.0f} '
+              f'{errors["writes"]:>13} {errors["reads"]:>12}')
+
+
+if __name__ == '__main__':
+    main()
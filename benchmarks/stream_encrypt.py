@@ -0,0 +1,158 @@
+"""Peak memory and throughput of sealing an attachment: whole-file AES-GCM versus the chunked stream.
+
+The whole-file case is what encrypt_message would need for an attachment:
+the plaintext, ciphertext and base64 copies all in memory. The stream
+case goes disk to disk through StreamEncryptor and back through
+StreamDecryptor. The LAN case uploads the file through /upload_file to a
+second network manager on localhost, with an encryption session between the
+two users. It checks that share_file's send_file sealed the body and that
+the receiver opened it intact:
+
+    python benchmarks/stream_encrypt.py [megabytes]
+"""
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from base64 import b64encode
+from concurrent.futures import Future
+from queue import Queue
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from config import Config
+from app import create_app, db, network, encryption
+from app.encryption import E2EEncryption, StreamEncryptor, StreamDecryptor
+from app.models import User
+from app.network import NetworkManager
+
+READ_SIZE = 256 * 1024
+
+
+def measure(label, size, fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f'  {label:34s} peak {peak / 2**20:7.2f} MB, {size / 2**20 / elapsed:7.1f} MB/s')
+
+
+class LocalManager(NetworkManager):
+    """NetworkManager on a free localhost port, without zeroconf; received files go to ``received``"""
+    tcp_port = 0
+
+    def __init__(self, user_phone, app):
+        super().__init__(user_phone, app)
+        self.received = Queue()
+
+    def _start_discovery(self):
+        pass
+
+    def _stop_discovery(self):
+        pass
+
+    def _file_received(self, header, filename, file_type, path):
+        self.received.put((header, path))
+        stored = Future()
+        stored.set_result(True)
+        return stored
+
+
+def lan_transfer(source, size, workdir):
+    """Upload ``source`` to a LAN peer as share_file does; returns seconds until the peer has it"""
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f'sqlite:///{os.path.join(workdir, "app.db")}'
+        BLOB_FOLDER = os.path.join(workdir, 'blobs')
+        KEYSTORE_FOLDER = os.path.join(workdir, 'keys')
+        MAX_CONTENT_LENGTH = None
+        TESTING = True
+    app = create_app(BenchConfig)
+    with app.app_context():
+        alice, bob = User(phone_number='+10000000001', display_name='Alice'), User(phone_number='+10000000002', display_name='Bob')
+        db.session.add_all([alice, bob])
+        db.session.commit()
+        alice_id, bob_id = alice.id, bob.id
+
+    # Alice's manager is the app's; Bob's shares her session's root key, as a completed handshake would
+    encryption.init_encryption(alice_id, app)
+    sender_keys, receiver_keys = encryption.get_encryption_manager(), E2EEncryption(bob_id)
+    sender_keys.initialize_session(receiver_keys.get_public_bundle(), bob_id)
+    receiver_keys.initialize_session(sender_keys.get_public_bundle(), alice_id)
+    ratchet = receiver_keys.sessions[alice_id]['ratchet']
+    ratchet.root_key = sender_keys.sessions[bob_id]['ratchet'].root_key
+    ratchet.init_chains(bob_id, alice_id)
+
+    sender, receiver = LocalManager('+10000000001', app), LocalManager('+10000000002', app)
+    receiver._file_decryptor = lambda header: receiver_keys.file_decryptor(alice_id)
+    sender.start()
+    receiver.start()
+    sender.peer_cache.update('+10000000002', '127.0.0.1', receiver.tcp_port)
+    network.network_manager = sender
+    try:
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(alice_id)
+        started = time.perf_counter()
+        with open(source, 'rb') as f:
+            reply = client.post('/upload_file', data={'file': (f, 'attachment.zip'), 'receiver_phone': '+10000000002'}).json
+        assert reply['success'], reply
+        header, path = receiver.received.get(timeout=300)
+        elapsed = time.perf_counter() - started
+    finally:
+        sender.stop()
+        receiver.stop()
+        sender_keys.close()
+
+    # _receive_file already checked the SHA-256 of the opened file
+    assert header.get('encrypted'), 'the attachment went over the LAN unencrypted'
+    assert os.path.getsize(path) == size
+    os.remove(path)
+    return elapsed
+
+
+def main(megabytes):
+    size = megabytes * 2**20
+    key = os.urandom(32)
+    workdir = tempfile.mkdtemp()
+    source, sealed, opened = (os.path.join(workdir, name) for name in ('plain', 'sealed', 'opened'))
+    with open(source, 'wb') as f:
+        for _ in range(megabytes):
+            f.write(os.urandom(2**20))
+
+    def whole_file():
+        with open(source, 'rb') as f:
+            data = f.read()
+        ciphertext = AESGCM(key).encrypt(os.urandom(12), data, None)
+        with open(sealed, 'wb') as f:
+            f.write(b64encode(ciphertext))
+
+    def stream_encrypt():
+        with open(source, 'rb') as src, open(sealed, 'wb') as dst:
+            for chunk in StreamEncryptor(key, 0).chunks(src):
+                dst.write(chunk)
+
+    def stream_decrypt():
+        decryptor = StreamDecryptor(lambda message_number: key)
+        with open(sealed, 'rb') as src, open(opened, 'wb') as dst:
+            for block in iter(lambda: src.read(READ_SIZE), b''):
+                dst.write(decryptor.update(block))
+            dst.write(decryptor.finalize())
+
+    print(f'{megabytes} MB attachment')
+    measure('whole file, AES-GCM + base64', size, whole_file)
+    measure('stream encrypt, disk to disk', size, stream_encrypt)
+    measure('stream decrypt, disk to disk', size, stream_decrypt)
+    with open(source, 'rb') as a, open(opened, 'rb') as b:
+        assert a.read() == b.read()
+    elapsed = lan_transfer(source, size, workdir)
+    print(f'  {"upload_file to a LAN peer, sealed":34s} {size / 2**20 / elapsed:7.1f} MB/s end to end')
+    shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 64)
@@ -5,9 +5,72 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'your-secret-key-here'
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///app.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    
+    # PRAGMAs applied to every new SQLite connection (see ProductionConfig)
+    SQLITE_PRAGMAS = {}
+
+    # Chat history pagination
+    MESSAGES_PER_PAGE = 50
+    MAX_MESSAGES_PER_PAGE = 200
+
+    # Group commit: buffer incoming chat messages and insert them in one transaction
+    MESSAGE_GROUP_COMMIT = os.environ.get('MESSAGE_GROUP_COMMIT', '').lower() in ('1', 'true', 'yes')
+    MESSAGE_BATCH_MAX_ROWS = 64
+    MESSAGE_BATCH_MAX_DELAY = 0.005  # seconds
+
+    # LAN outbox: undelivered messages are retried with exponential backoff and jitter
+    OUTBOX_RETRY_BASE = 2  # seconds
+    OUTBOX_RETRY_MAX = 300  # seconds
+    OUTBOX_FAIL_AFTER = 8  # attempts before a message shows as failed; retries continue
+
+    # LAN transport engine: 'threaded' (a thread per connection) or 'asyncio' (one event-loop thread)
+    NETWORK_ENGINE = os.environ.get('NETWORK_ENGINE', 'threaded')
+
+    # Per-user identity keys, pre-keys and encryption sessions, one SQLite file per user
+    KEYSTORE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'keys')
+
     # File upload settings
     UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'static', 'uploads')
-    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
+    # Content-addressed attachment store, kept outside static/ so files stay behind login
+    BLOB_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'blobs')
+    BLOB_MAX_AGE = 365 * 24 * 3600  # seconds; blobs are immutable
+    # Offload attachment bytes to a front proxy: set X_ACCEL_REDIRECT_PREFIX to an nginx
+    # internal location aliased to BLOB_FOLDER, or USE_X_SENDFILE for Apache/lighttpd
+    X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
+    USE_X_SENDFILE = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
+    MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max request body (single-request uploads)
+    # Chunked uploads stream each chunk to disk, so files may exceed MAX_CONTENT_LENGTH
+    UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB per chunk
+    MAX_UPLOAD_SIZE = 1024 * 1024 * 1024  # 1GB max file size
+    # Each open upload session holds a preallocated partial file on disk
+    MAX_OPEN_UPLOADS = 4  # per user
+    UPLOAD_SESSION_TTL = 24 * 3600  # seconds before an unfinished upload is discarded
     ALLOWED_IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
-    ALLOWED_FILE_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx', 'xls', 'xlsx', 'zip', 'rar'} 
\ No newline at end of file
+    ALLOWED_FILE_EXTENSIONS = {'txt', 'pdf', 'doc', 'docx', 'xls', 'xlsx', 'zip', 'rar'}
+    # Image thumbnails: name -> longest side in pixels
+    THUMBNAIL_SIZES = {'small': 160, 'medium': 480}
+    THUMBNAIL_MAX_AGE = 7 * 24 * 3600  # seconds 
+
+class ProductionConfig(Config):
+    """SQLite tuned for concurrent chat traffic: WAL lets readers run alongside the writer"""
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',        # Safe under WAL; fsync at checkpoints only
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64 * 1024,       # Negative values are KiB, i.e. 64MB
+        'busy_timeout': 5000,           # Milliseconds to wait for a lock before failing
+        'temp_store': 'MEMORY'
+    }
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_timeout': 30,
+        # Lock waits are bounded by the busy_timeout PRAGMA above
+        'connect_args': {
+            'check_same_thread': False
+        }
+    }
+
+config_profiles = {
+    'default': Config,
+    'production': ProductionConfig
+}
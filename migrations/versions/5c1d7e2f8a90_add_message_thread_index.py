@@ -0,0 +1,26 @@
+"""Add composite thread index to Message model
+
+Revision ID: 5c1d7e2f8a90
+Revises: 42a653bd3989
+Create Date: 2025-06-02 10:14:08.512337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1d7e2f8a90'
+down_revision = '42a653bd3989'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_thread', ['sender_id', 'receiver_id', 'timestamp', 'id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.drop_index('ix_message_thread')
@@ -0,0 +1,74 @@
+"""Add Conversation model and backfill Message.conversation_id
+
+Revision ID: b7e4a1c93d26
+Revises: 5c1d7e2f8a90
+Create Date: 2025-06-04 16:41:52.907114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7e4a1c93d26'
+down_revision = '5c1d7e2f8a90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('conversation',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_low_id', sa.Integer(), nullable=False),
+        sa.Column('user_high_id', sa.Integer(), nullable=False),
+        sa.Column('last_message_id', sa.Integer(), nullable=True),
+        sa.Column('last_activity', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['last_message_id'], ['message.id'], name='fk_conversation_last_message'),
+        sa.ForeignKeyConstraint(['user_high_id'], ['user.id'], ),
+        sa.ForeignKeyConstraint(['user_low_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_low_id', 'user_high_id', name='unique_conversation')
+    )
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.create_index(batch_op.f('ix_conversation_user_high_id'), ['user_high_id'], unique=False)
+        batch_op.create_index(batch_op.f('ix_conversation_last_activity'), ['last_activity'], unique=False)
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('conversation_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_message_conversation', 'conversation', ['conversation_id'], ['id'])
+        batch_op.create_index('ix_message_conversation', ['conversation_id', 'timestamp', 'id'], unique=False)
+        # Threads are now looked up by conversation; the sender/receiver index is redundant
+        batch_op.drop_index('ix_message_thread')
+
+    # Backfill: one conversation per unordered sender/receiver pair
+    low = 'CASE WHEN sender_id < receiver_id THEN sender_id ELSE receiver_id END'
+    high = 'CASE WHEN sender_id < receiver_id THEN receiver_id ELSE sender_id END'
+    op.execute(
+        f'INSERT INTO conversation (user_low_id, user_high_id) '
+        f'SELECT DISTINCT {low}, {high} FROM message'
+    )
+    op.execute(
+        f'UPDATE message SET conversation_id = ('
+        f'SELECT c.id FROM conversation c '
+        f'WHERE c.user_low_id = {low} AND c.user_high_id = {high})'
+    )
+    op.execute(
+        'UPDATE conversation SET '
+        'last_message_id = (SELECT m.id FROM message m WHERE m.conversation_id = conversation.id '
+        'ORDER BY m.timestamp DESC, m.id DESC LIMIT 1), '
+        'last_activity = (SELECT MAX(m.timestamp) FROM message m WHERE m.conversation_id = conversation.id)'
+    )
+
+
+def downgrade():
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.create_index('ix_message_thread', ['sender_id', 'receiver_id', 'timestamp', 'id'], unique=False)
+        batch_op.drop_index('ix_message_conversation')
+        batch_op.drop_constraint('fk_message_conversation', type_='foreignkey')
+        batch_op.drop_column('conversation_id')
+
+    with op.batch_alter_table('conversation', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_conversation_last_activity'))
+        batch_op.drop_index(batch_op.f('ix_conversation_user_high_id'))
+
+    op.drop_table('conversation')
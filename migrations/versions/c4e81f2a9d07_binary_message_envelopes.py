@@ -0,0 +1,89 @@
+"""Store encrypted message envelopes as binary
+
+Revision ID: c4e81f2a9d07
+Revises: 7a2c9d41b6e8
+Create Date: 2025-06-18 09:37:12.204519
+
+"""
+from base64 import b64decode, b64encode
+import json
+import struct
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e81f2a9d07'
+down_revision = '7a2c9d41b6e8'
+branch_labels = None
+depends_on = None
+
+# Rows converted per statement
+BATCH_SIZE = 500
+
+# Frozen copy of app.encryption's envelope format at this revision
+ENVELOPE_VERSION = 2
+ENVELOPE_HEADER = struct.Struct('!BI12s')
+
+
+def _json_to_binary(text):
+    try:
+        message_data = json.loads(text)
+        return ENVELOPE_HEADER.pack(
+            ENVELOPE_VERSION, message_data['message_number'], b64decode(message_data['nonce'])
+        ) + b64decode(message_data['ciphertext'])
+    except (ValueError, KeyError, TypeError, struct.error):
+        # Not a JSON envelope we can parse; keep its bytes as they are
+        return text.encode()
+
+
+def _binary_to_json(data):
+    if data[:1] == b'{' or len(data) < ENVELOPE_HEADER.size:
+        return data.decode()
+    _, message_number, nonce = ENVELOPE_HEADER.unpack_from(data)
+    return json.dumps({
+        'ciphertext': b64encode(data[ENVELOPE_HEADER.size:]).decode(),
+        'nonce': b64encode(nonce).decode(),
+        'message_number': message_number
+    })
+
+
+def _convert(stored_type, convert):
+    """Rewrite every envelope stored as ``stored_type`` ('text' or 'blob'), one batch of ids at a time"""
+    bind = op.get_bind()
+    last_id = 0
+    while True:
+        rows = bind.execute(sa.text(
+            'SELECT id, encrypted_content FROM message '
+            'WHERE id > :last_id AND typeof(encrypted_content) = :stored_type '
+            'ORDER BY id LIMIT :limit'
+        ), {'last_id': last_id, 'stored_type': stored_type, 'limit': BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+        bind.execute(
+            sa.text('UPDATE message SET encrypted_content = :content WHERE id = :id'),
+            [{'id': row_id, 'content': convert(content)} for row_id, content in rows]
+        )
+        last_id = rows[-1][0]
+
+
+def upgrade():
+    # Convert first: rebuilding the table casts every remaining value to the new type
+    _convert('text', _json_to_binary)
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.alter_column('encrypted_content',
+               existing_type=sa.Text(),
+               type_=sa.LargeBinary(),
+               existing_nullable=True)
+
+
+def downgrade():
+    _convert('blob', _binary_to_json)
+
+    with op.batch_alter_table('message', schema=None) as batch_op:
+        batch_op.alter_column('encrypted_content',
+               existing_type=sa.LargeBinary(),
+               type_=sa.Text(),
+               existing_nullable=True)
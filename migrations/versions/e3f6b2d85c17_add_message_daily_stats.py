@@ -0,0 +1,49 @@
+"""Add MessageDailyStats rollup table
+
+Revision ID: e3f6b2d85c17
+Revises: b7e4a1c93d26
+Create Date: 2025-06-06 11:03:27.644519
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e3f6b2d85c17'
+down_revision = 'b7e4a1c93d26'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('message_daily_stats',
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=False),
+        sa.Column('sent', sa.Integer(), nullable=False),
+        sa.Column('delivered', sa.Integer(), nullable=False),
+        sa.Column('encrypted', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+        sa.PrimaryKeyConstraint('user_id', 'day')
+    )
+
+    # Backfill from existing messages; `flask rebuild-stats` does the same later on
+    op.execute(
+        "INSERT INTO message_daily_stats (user_id, day, total, sent, delivered, encrypted) "
+        "SELECT user_id, day, COUNT(*), SUM(sent), SUM(delivered), SUM(encrypted) FROM ("
+        "  SELECT sender_id AS user_id, date(timestamp) AS day, 1 AS sent,"
+        "         CASE WHEN status = 'DELIVERED' THEN 1 ELSE 0 END AS delivered,"
+        "         CASE WHEN is_encrypted = 1 THEN 1 ELSE 0 END AS encrypted"
+        "  FROM message"
+        "  UNION ALL"
+        "  SELECT receiver_id, date(timestamp), 0,"
+        "         CASE WHEN status = 'DELIVERED' THEN 1 ELSE 0 END,"
+        "         CASE WHEN is_encrypted = 1 THEN 1 ELSE 0 END"
+        "  FROM message WHERE receiver_id != sender_id"
+        ") GROUP BY user_id, day"
+    )
+
+
+def downgrade():
+    op.drop_table('message_daily_stats')
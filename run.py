@@ -1,6 +1,8 @@
+import os
 from app import create_app, socketio
+from config import config_profiles
 
-app = create_app()
+app = create_app(config_profiles[os.environ.get('APP_PROFILE', 'default')])
 
 if __name__ == '__main__':
     socketio.run(app, host='0.0.0.0', port=5000, debug=True) 
\ No newline at end of file